@@ -1,11 +1,15 @@
 import os
+import copy
+import hashlib
 import torch
+from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
 from PIL import Image
-import geopandas as gpd
 import timm
-import sys
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
 from collections import Counter
+from vector_io import read_vector, write_vector
 
 # Путь к модели и другим файлам
 MODEL_PATH = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\model\efficientnet_b7.pth"
@@ -20,15 +24,21 @@ CLASS_MAPPING = {
     2: "сосна"
 }
 
-# Проверка существования файла модели
-if not os.path.exists(MODEL_PATH):
-    print(f"Ошибка: Файл модели {MODEL_PATH} не найден.")
-    sys.exit(1)
+# Цвета точек видов дерева (XZ — green, YZ — purple), как на графиках профилей matplotlib
+VIEW_COLORS = ((0.0, 0.502, 0.0), (0.502, 0.0, 0.502))
 
-def load_model(model_path):
+# Загруженные модели текущего процесса: {(путь, время изменения файла): модель}
+_model_cache = {}
+
+
+def load_model(model_path, model_name='efficientnet_b7'):
+    # Проверка существования файла модели
+    if not os.path.exists(model_path):
+        print(f"Ошибка: Файл модели {model_path} не найден.")
+        raise FileNotFoundError(model_path)
     try:
-        # Загрузка модели через timm
-        model = timm.create_model('efficientnet_b7', pretrained=False)
+        # Загрузка модели через timm (efficientnet_b0 ... efficientnet_b7)
+        model = timm.create_model(model_name, pretrained=False)
         num_classes = len(CLASS_MAPPING)  # Укажите количество классов в вашей задаче
         model.classifier = torch.nn.Linear(model.classifier.in_features, num_classes)
         model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
@@ -39,13 +49,166 @@ def load_model(model_path):
         print(f"Ошибка при загрузке модели: {e}")
         raise
 
-# Предобработка изображения
-def preprocess_image(image_path):
-    transform = transforms.Compose([
-        transforms.Resize((600, 600)),  # Размер входного изображения для EfficientNet-B7
+def quantize_model(model, quantization, calibration_batches=None, image_size=600):
+    """
+    Квантование модели в int8 после обучения для вычислений на CPU.
+    quantization="static" — статическое квантование всей сети (FX), масштабы активаций
+    подбираются по calibration_batches (итерируемый набор батчей изображений, см. calibration_set).
+    Динамическое квантование не поддерживается: оно затрагивает только полносвязные слои,
+    а у EfficientNet это лишь выходной слой classifier.
+    """
+    if not quantization:
+        return model
+    if quantization == "static":
+        example = torch.zeros((1, 3, image_size, image_size))
+        qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+        prepared = prepare_fx(copy.deepcopy(model), qconfig_mapping, example_inputs=(example,))
+        n_batches = 0
+        with torch.inference_mode():
+            for images in calibration_batches or []:
+                prepared(images)
+                n_batches += 1
+        if n_batches == 0:
+            print("Предупреждение: нет изображений для калибровки, масштабы активаций не подобраны.")
+        model = convert_fx(prepared)
+    else:
+        raise ValueError(f"Неизвестный режим квантования: {quantization}")
+    model.eval()
+    print(f"Модель квантована ({quantization}, int8).")
+    return model
+
+
+def calibration_set(calibration_folder, calibration_size=64):
+    """
+    Фиксированная выборка для калибровки статического квантования: первые calibration_size
+    изображений профилей (PNG/JPG) из calibration_folder и вложенных папок в порядке сортировки путей.
+    Возвращает (список файлов, ключ набора) — ключ строится по именам, размерам и времени
+    изменения файлов и входит в имя скомпилированной модели, поэтому при смене выборки модель пересобирается.
+    """
+    if not calibration_folder or not os.path.isdir(calibration_folder):
+        print(f"Ошибка: папка выборки для калибровки {calibration_folder} не найдена.")
+        raise ValueError("Для статического квантования нужна выборка для калибровки (CALIBRATION_FOLDER).")
+    files = []
+    for root, _, file_names in os.walk(calibration_folder):
+        for file_name in file_names:
+            if file_name.lower().endswith((".png", ".jpg", ".jpeg")):
+                files.append(os.path.join(root, file_name))
+    files = sorted(files)[:calibration_size]
+    if not files:
+        print(f"Ошибка: в папке {calibration_folder} нет изображений для калибровки.")
+        raise ValueError("Для статического квантования нужна выборка для калибровки (CALIBRATION_FOLDER).")
+
+    digest = hashlib.sha1()
+    for file_path in files:
+        stat = os.stat(file_path)
+        relative_path = os.path.relpath(file_path, calibration_folder).replace(os.sep, "/")
+        digest.update(f"{relative_path}|{stat.st_size}|{stat.st_mtime_ns}\n".encode("utf-8"))
+    return files, digest.hexdigest()[:10]
+
+
+def iter_calibration_batches(calibration_files, image_size=600, batch_size=8):
+    """
+    Батчи изображений выборки для калибровки (с той же предобработкой, что при классификации).
+    """
+    transform = build_transform(image_size)
+    for start in range(0, len(calibration_files), batch_size):
+        yield torch.stack([transform(Image.open(file_path).convert("RGB"))
+                           for file_path in calibration_files[start:start + batch_size]])
+
+
+def compiled_model_path(model_path, model_name='efficientnet_b7', image_size=600, quantization=None,
+                        calibration_key=None, cache_folder=None):
+    """
+    Путь к скомпилированной (TorchScript) модели рядом с файлом весов (или в cache_folder).
+    Для статического квантования в имя входит ключ выборки для калибровки (см. calibration_set).
+    """
+    suffix = f".{model_name}_{image_size}" + (f"_{quantization}" if quantization else "")
+    suffix += f"_{calibration_key}" if calibration_key else ""
+    base_name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(cache_folder or os.path.dirname(model_path), base_name + suffix + ".torchscript.pt")
+
+
+def compile_model(model_path, model_name='efficientnet_b7', image_size=600, quantization=None,
+                  calibration_files=None, output_path=None):
+    """
+    Сборка модели из весов и сохранение ее в формате TorchScript (трассировка и заморозка графа).
+    calibration_files — изображения для калибровки статического квантования (см. calibration_set),
+    output_path — путь к файлу модели (None — см. compiled_model_path).
+    """
+    model = load_model(model_path, model_name)
+    model = quantize_model(model, quantization, iter_calibration_batches(calibration_files or [], image_size),
+                           image_size)
+    with torch.inference_mode():
+        example = torch.zeros((1, 3, image_size, image_size))
+        compiled = torch.jit.freeze(torch.jit.trace(model, example))
+    output_path = output_path or compiled_model_path(model_path, model_name, image_size, quantization)
+    try:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        compiled.save(output_path)
+        print(f"Скомпилированная модель сохранена: {output_path}")
+    except Exception as e:
+        print(f"Не удалось сохранить скомпилированную модель {output_path}: {e}")
+    return compiled
+
+
+def get_model(model_path, compiled=True, model_name='efficientnet_b7', image_size=600, quantization=None,
+              calibration_folder=None, calibration_size=64, cache_folder=None):
+    """
+    Модель для классификации с кэшированием.
+    Модель загружается при первом обращении и хранится в памяти процесса, поэтому повторные
+    запуски этапа (например, из приложения) не собирают ее заново. При compiled=True используется
+    скомпилированная модель TorchScript рядом с файлом весов; она пересобирается, если файл весов новее.
+    quantization — режим квантования int8 (None или "static", см. quantize_model);
+    статическое квантование калибруется по фиксированной выборке calibration_folder (см. calibration_set),
+    а не по классифицируемым данным, поэтому модель одинакова для конвейера, пакетного режима и сервиса.
+    cache_folder — папка скомпилированных моделей (None — рядом с файлом весов).
+    """
+    if not os.path.exists(model_path):
+        print(f"Ошибка: Файл модели {model_path} не найден.")
+        raise FileNotFoundError(model_path)
+
+    calibration_files, calibration_key = None, None
+    if quantization == "static":
+        calibration_files, calibration_key = calibration_set(calibration_folder, calibration_size)
+
+    key = (os.path.abspath(model_path), os.path.getmtime(model_path), compiled, model_name, image_size, quantization,
+           calibration_key, cache_folder)
+    if key in _model_cache:
+        return _model_cache[key]
+
+    if not compiled:
+        model = load_model(model_path, model_name)
+        model = quantize_model(model, quantization, iter_calibration_batches(calibration_files or [], image_size),
+                               image_size)
+    else:
+        script_path = compiled_model_path(model_path, model_name, image_size, quantization, calibration_key,
+                                          cache_folder)
+        model = None
+        if os.path.exists(script_path) and os.path.getmtime(script_path) >= os.path.getmtime(model_path):
+            try:
+                model = torch.jit.load(script_path, map_location=torch.device('cpu'))
+                model.eval()
+                print(f"Скомпилированная модель загружена: {script_path}")
+            except Exception as e:
+                print(f"Ошибка при загрузке скомпилированной модели {script_path}: {e}")
+        if model is None:
+            model = compile_model(model_path, model_name, image_size, quantization, calibration_files, script_path)
+
+    _model_cache.clear()
+    _model_cache[key] = model
+    return model
+
+# Преобразования изображения для EfficientNet
+def build_transform(image_size=600):
+    return transforms.Compose([
+        transforms.Resize((image_size, image_size)),  # Размер входного изображения (600 для EfficientNet-B7)
         transforms.ToTensor(),
         transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
     ])
+
+# Предобработка изображения
+def preprocess_image(image_path, image_size=600):
+    transform = build_transform(image_size)
     image = Image.open(image_path).convert("RGB")
     return transform(image).unsqueeze(0)
 
@@ -56,63 +219,178 @@ def classify_image(model, image_tensor):
         _, predicted = torch.max(outputs, 1)
     return predicted.item()
 
+
+class TreeProfileDataset(Dataset):
+    """
+    Датасет профилей деревьев: элемент — все найденные виды одного дерева
+    ({tree_id}_1.png и {tree_id}_2.png), поэтому оба вида попадают в один батч.
+    """
+
+    def __init__(self, tree_ids, image_folder, image_size=600):
+        self.image_size = image_size
+        self.transform = build_transform(image_size)
+        self.samples = []
+        for position, tree_id in enumerate(tree_ids):
+            image_paths = []
+            for image_name in [f"{tree_id}_1.png", f"{tree_id}_2.png"]:
+                image_path = os.path.join(image_folder, image_name)
+
+                # Проверка существования изображения
+                if not os.path.exists(image_path):
+                    print(f"Изображение {image_name} для дерева с ID {tree_id} не найдено. Пропускаем.")
+                    continue
+                image_paths.append(image_path)
+            if image_paths:
+                self.samples.append((position, tree_id, image_paths))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        position, tree_id, image_paths = self.samples[index]
+        images = []
+        for image_path in image_paths:
+            try:
+                images.append(self.transform(Image.open(image_path).convert("RGB")))
+            except Exception as e:
+                print(f"Ошибка при чтении изображения {image_path} для дерева с ID {tree_id}: {e}")
+        if not images:
+            return position, torch.empty((0, 3, self.image_size, self.image_size))
+        return position, torch.stack(images)
+
+
+def profile_to_tensor(profile, image_size=600, color=VIEW_COLORS[0]):
+    """
+    Преобразование профиля (H, W) с непрозрачностью точек [0, 1] в нормализованный тензор (3, image_size, image_size).
+    Точки цвета color накладываются на белый фон, как на графиках профилей.
+    """
+    coverage = torch.as_tensor(profile, dtype=torch.float32).unsqueeze(0)
+    color = torch.tensor(color, dtype=torch.float32).view(3, 1, 1)
+    image = 1.0 - coverage * (1.0 - color)
+    if image.shape[1:] != (image_size, image_size):
+        image = torch.nn.functional.interpolate(image.unsqueeze(0), size=(image_size, image_size),
+                                                mode="bilinear", align_corners=False)[0]
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+    return (image - mean) / std
+
+
+class TreeProfileArrayDataset(Dataset):
+    """
+    Датасет профилей деревьев, построенных в памяти (без PNG):
+    элемент — оба вида (XZ и YZ) одного дерева. Профили берутся из profiles при чтении элемента,
+    поэтому ленивые профили (tree_profile.TreeProfiles) строятся по батчам, а не все сразу.
+    """
+
+    def __init__(self, tree_ids, profiles, image_size=600):
+        self.image_size = image_size
+        self.profiles = profiles
+        self.samples = []
+        for position, tree_id in enumerate(tree_ids):
+            if tree_id not in profiles:
+                print(f"Профили для дерева с ID {tree_id} не найдены. Пропускаем.")
+                continue
+            self.samples.append((position, tree_id))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        position, tree_id = self.samples[index]
+        views = self.profiles[tree_id]
+        return position, torch.stack([profile_to_tensor(view, self.image_size, color)
+                                      for view, color in zip(views, VIEW_COLORS)])
+
+
+def collate_tree_views(batch):
+    """
+    Объединение деревьев в батч: виды всех деревьев склеиваются в один тензор,
+    для каждого вида запоминается позиция его дерева.
+    """
+    positions = torch.cat([torch.full((len(images),), position, dtype=torch.long) for position, images in batch])
+    images = torch.cat([images for _, images in batch])
+    return positions, images
+
+
+def vote_tree_class(classifications):
+    """
+    Класс дерева по классам его видов.
+    """
+    # Выбор наиболее часто встречающегося класса (или первого, если все разные)
+    most_common_class = Counter(classifications).most_common(1)[0][0]
+    # Преобразование числового класса в название
+    return CLASS_MAPPING.get(most_common_class, "неизвестный")
+
+
 # Основная функция
-def classify_trees_and_update_shp(model_path, image_folder, shp_path, output_shp_path):
-    # Загрузка модели
-    model = load_model(model_path)
+def classify_trees_and_update_shp(model_path, image_folder, shp_path, output_shp_path,
+                                  batch_size=8, num_workers=4, num_threads=None, profiles=None, compiled=True,
+                                  model_name='efficientnet_b7', image_size=600, quantization=None,
+                                  calibration_folder=None, calibration_size=64, crowns_gdf=None):
+    """
+    Пакетная классификация деревьев на CPU.
+    Изображения декодируются и масштабируются в num_workers процессах DataLoader,
+    в батче batch_size деревьев (по два вида на дерево), вычисления в num_threads потоках torch.
+    Если переданы profiles ({tree_id: (профиль XZ, профиль YZ)}), классифицируются
+    профили из памяти, а изображения из image_folder не читаются.
+    Модель загружается один раз на процесс (при compiled=True — из кэша TorchScript).
+    model_name и image_size задают архитектуру timm и размер входа (efficientnet_b0 ... efficientnet_b7),
+    quantization — режим квантования int8; статическое квантование калибруется по первым
+    calibration_size изображениям фиксированной выборки calibration_folder (см. get_model).
+    crowns_gdf — слой крон в памяти (с этапа 5); если он задан, shp_path не читается.
+    """
+    # Настройка числа потоков torch для вычислений на CPU
+    torch.set_num_threads(num_threads or os.cpu_count() or 1)
 
     # Загрузка SHP-файла
-    crowns_gdf = gpd.read_file(shp_path)
+    if crowns_gdf is None:
+        crowns_gdf = read_vector(shp_path)
+    else:
+        crowns_gdf = crowns_gdf.copy()
     if 'tree_id' not in crowns_gdf.columns:
         raise ValueError("SHP-файл должен содержать атрибут 'tree_id'!")
 
     # Создание нового столбца для класса дерева
     crowns_gdf['tree_class'] = None
 
-    # Обработка каждого дерева
-    for idx, row in crowns_gdf.iterrows():
-        tree_id = row['tree_id']
-
-        # Проверка существования изображений с суффиксами _1 и _2
-        image_names = [f"{tree_id}_1.png", f"{tree_id}_2.png"]
-        classifications = []
+    # Пакетная обработка деревьев
+    tree_ids = crowns_gdf['tree_id'].tolist()
+    if profiles is not None:
+        # Профили строятся по облакам точек в памяти при чтении батча (без декодирования PNG), отдельные процессы не нужны
+        dataset = TreeProfileArrayDataset(tree_ids, profiles, image_size)
+        num_workers = 0
+    else:
+        dataset = TreeProfileDataset(tree_ids, image_folder, image_size)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                        collate_fn=collate_tree_views)
 
-        for image_name in image_names:
-            image_path = os.path.join(image_folder, image_name)
-
-            # Проверка существования изображения
-            if not os.path.exists(image_path):
-                print(f"Изображение {image_name} для дерева с ID {tree_id} не найдено. Пропускаем.")
-                continue
+    # Загрузка модели
+    model = get_model(model_path, compiled=compiled, model_name=model_name, image_size=image_size,
+                      quantization=quantization, calibration_folder=calibration_folder,
+                      calibration_size=calibration_size)
 
-            # Классификация изображения
-            try:
-                image_tensor = preprocess_image(image_path)
-                tree_class = classify_image(model, image_tensor)
-                classifications.append(tree_class)
-                print(f"Дерево с ID {tree_id}, изображение {image_name} классифицировано как класс {tree_class}.")
-            except Exception as e:
-                print(f"Ошибка при классификации дерева с ID {tree_id}, изображение {image_name}: {e}")
+    classifications = [[] for _ in tree_ids]
+    with torch.inference_mode():
+        for positions, images in loader:
+            if len(images) == 0:
                 continue
+            predicted = model(images).argmax(dim=1)
+            for position, tree_class in zip(positions.tolist(), predicted.tolist()):
+                classifications[position].append(tree_class)
 
+    for position, (idx, tree_id) in enumerate(zip(crowns_gdf.index, tree_ids)):
         # Если есть хотя бы одна классификация, используем её
-        if classifications:
-            # Выбор наиболее часто встречающегося класса (или первого, если все разные)
-            most_common_class = Counter(classifications).most_common(1)[0][0]
-            # Преобразование числового класса в название
-            class_name = CLASS_MAPPING.get(most_common_class, "неизвестный")
+        if classifications[position]:
+            class_name = vote_tree_class(classifications[position])
             crowns_gdf.at[idx, 'tree_class'] = class_name
+            print(f"Дерево с ID {tree_id} классифицировано как {class_name} (классы видов: {classifications[position]}).")
         else:
             print(f"Для дерева с ID {tree_id} не найдено ни одного изображения.")
 
     # Сохранение обновленного SHP-файла
-    crowns_gdf.to_file(output_shp_path, driver="ESRI Shapefile")
-    print(f"Обновленный SHP-файл сохранен: {output_shp_path}")
-
-# Проверка существования файла модели
-if not os.path.exists(MODEL_PATH):
-    print(f"Ошибка: Файл модели {MODEL_PATH} не найден.")
-    sys.exit(1)
+    write_vector(crowns_gdf, output_shp_path)
+    print(f"Обновленный слой крон сохранен: {output_shp_path}")
+    return crowns_gdf
 
 # Выполнение
 if __name__ == "__main__":
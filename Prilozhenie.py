@@ -3,6 +3,8 @@ from tkinter import ttk, scrolledtext, filedialog, messagebox
 import pandas as pd
 import geopandas as gpd
 import threading
+from config import OUTPUT_SHP_PATH
+from vector_io import read_vector
 from stage_1_raster_creation import stage_1
 from stage_2_tree_detection import stage_2
 from stage_3_crown_polygons import stage_3
@@ -80,18 +82,21 @@ class ForestTaxationApp:
             ))
 
     def load_data_from_shp(self):
-        """Загружает данные из SHP-файла."""
-        shp_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_class.shp"
+        """Загружает данные из итогового слоя крон (GeoParquet, FlatGeobuf или SHP)."""
+        shp_path = OUTPUT_SHP_PATH
         try:
-            # Загрузка SHP-файла
-            gdf = gpd.read_file(shp_path)
+            # Загрузка слоя крон
+            gdf = read_vector(shp_path)
+
+            # В Shapefile название атрибута высоты усекается до 10 символов
+            height_column = "height_tree_las" if "height_tree_las" in gdf.columns else "height_tre"
 
             # Извлечение данных
             self.tree_data = pd.DataFrame({
                 "ID": gdf["tree_id"],
                 "X Координата": gdf["x_coord"],  # Координата X
                 "Y Координата": gdf["y_coord"],  # Координата Y
-                "Высота (м)": gdf["height_tre"],  # Учитываем усечение названий столбцов
+                "Высота (м)": gdf[height_column],
                 "Диаметр (м)": gdf["diameter"],  # Используем диаметр вместо ширины кроны
                 "Класс": gdf["tree_class"]
             })
@@ -104,9 +109,9 @@ class ForestTaxationApp:
 
             # Обновление таблицы
             self.update_tree_table()
-            messagebox.showinfo("Успех", f"Данные успешно загружены из SHP-файла: {shp_path}")
+            messagebox.showinfo("Успех", f"Данные успешно загружены из слоя: {shp_path}")
         except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось загрузить данные из SHP-файла: {e}")
+            messagebox.showerror("Ошибка", f"Не удалось загрузить данные из слоя: {e}")
 
     def save_table(self):
         """Сохраняет таблицу в CSV-файл."""
@@ -171,32 +176,37 @@ class ForestTaxationApp:
 
     def run_stage_1(self):
         self.log_message("Начало этапа 1: Создание растров...")
-        stage_1()
+        rasters = stage_1()
         self.log_message("Этап 1 завершен.")
+        return rasters
 
-    def run_stage_2(self):
+    def run_stage_2(self, rasters=None):
         self.log_message("Начало этапа 2: Поиск вершин деревьев...")
-        stage_2()
+        tree_tops_gdf = stage_2(rasters)
         self.log_message("Этап 2 завершен.")
+        return tree_tops_gdf
 
-    def run_stage_3(self):
+    def run_stage_3(self, tree_tops_gdf=None):
         self.log_message("Начало этапа 3: Построение крон...")
-        stage_3()
+        crowns_gdf = stage_3(tree_tops_gdf)
         self.log_message("Этап 3 завершен.")
+        return crowns_gdf
 
-    def run_stage_4(self):
+    def run_stage_4(self, crowns_gdf=None):
         self.log_message("Начало этапа 4: Вырезание деревьев...")
-        stage_4()
+        tree_points = stage_4(crowns_gdf)
         self.log_message("Этап 4 завершен.")
+        return tree_points
 
-    def run_stage_5(self):
+    def run_stage_5(self, tree_points=None, crowns_gdf=None):
         self.log_message("Начало этапа 5: Добавление атрибутов...")
-        stage_5()
+        crowns_gdf, profiles = stage_5(tree_points, crowns_gdf)
         self.log_message("Этап 5 завершен.")
+        return crowns_gdf, profiles
 
-    def run_stage_6(self):
+    def run_stage_6(self, profiles=None, crowns_gdf=None):
         self.log_message("Начало этапа 6: Классификация деревьев...")
-        stage_6()
+        stage_6(profiles, crowns_gdf)
         self.log_message("Этап 6 завершен.")
 
         # Загрузка данных из SHP-файла после завершения классификации
@@ -205,12 +215,13 @@ class ForestTaxationApp:
 
     def run_all_stages(self):
         self.log_message("Начало обработки проекта таксации леса...")
-        self.run_stage_1()
-        self.run_stage_2()
-        self.run_stage_3()
-        self.run_stage_4()
-        self.run_stage_5()
-        self.run_stage_6()
+        # Результаты этапов передаются следующим этапам в памяти, без повторного чтения с диска
+        rasters = self.run_stage_1()
+        tree_tops_gdf = self.run_stage_2(rasters)
+        crowns_gdf = self.run_stage_3(tree_tops_gdf)
+        tree_points = self.run_stage_4(crowns_gdf)
+        crowns_gdf, profiles = self.run_stage_5(tree_points, crowns_gdf)
+        self.run_stage_6(profiles, crowns_gdf)
         self.log_message("Обработка завершена!")
 
 # Запуск приложения
@@ -0,0 +1,198 @@
+import io
+import os
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional
+
+import numpy as np
+import laspy
+import torch
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+
+from config import (MODEL_PATH, COMPILED_MODEL, MODEL_NAME, INPUT_SIZE, QUANTIZATION, PROFILE_IMAGE_SIZE,
+                    TORCH_THREADS, SERVICE_MAX_BATCH_SIZE, SERVICE_MAX_WAIT_MS, CLASSIFY_FROM_PNG,
+                    CALIBRATION_FOLDER, CALIBRATION_SIZE)
+from Efficintnet import get_model, build_transform, profile_to_tensor, vote_tree_class, VIEW_COLORS
+from tree_profile import render_tree_profiles, render_profile_plot_images
+
+
+class MicroBatcher:
+    """
+    Объединение одновременных запросов в один прямой проход модели.
+    Запросы копятся в очереди, пока в батче меньше max_batch_size видов и с момента
+    первого запроса прошло не больше max_wait_ms; виды одного запроса в разные батчи не делятся.
+    Прямой проход выполняется в отдельном потоке, чтобы не блокировать цикл событий.
+    """
+
+    def __init__(self, model, max_batch_size=16, max_wait_ms=20):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self.task
+        self.executor.shutdown()
+
+    async def predict(self, images):
+        """
+        Классы видов дерева (тензор (N, 3, H, W)) — список номеров классов.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((images, future))
+        return await future
+
+    def forward(self, images):
+        with torch.inference_mode():
+            return self.model(images).argmax(dim=1).tolist()
+
+    async def collect_batch(self):
+        """
+        Сбор запросов в батч до заполнения или до истечения времени ожидания.
+        """
+        loop = asyncio.get_running_loop()
+        requests = [await self.queue.get()]
+        n_views = len(requests[0][0])
+        deadline = loop.time() + self.max_wait
+        while n_views < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            requests.append(request)
+            n_views += len(request[0])
+        return requests
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self.collect_batch()
+            # Запросы, клиенты которых уже отключились, не классифицируются
+            requests = [(images, future) for images, future in requests if not future.done()]
+            if not requests:
+                continue
+            try:
+                images = torch.cat([images for images, _ in requests])
+                predicted = await loop.run_in_executor(self.executor, self.forward, images)
+            except Exception as e:
+                print(f"Ошибка при классификации батча: {e}")
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            start = 0
+            for images, future in requests:
+                if not future.done():
+                    future.set_result(predicted[start:start + len(images)])
+                start += len(images)
+
+
+class ProfileRequest(BaseModel):
+    """
+    Профили одного дерева: виды (XZ, YZ) — двумерные массивы непрозрачности точек со значениями [0, 1]
+    (см. tree_profile.rasterize_profile).
+    """
+    tree_id: Optional[int] = None
+    views: List[List[List[float]]]
+
+
+class ClassificationResponse(BaseModel):
+    tree_id: Optional[int] = None
+    tree_class: str
+    view_classes: List[int]
+
+
+def profiles_to_batch(views):
+    """
+    Тензор (N, 3, INPUT_SIZE, INPUT_SIZE) из профилей видов дерева.
+    """
+    tensors = []
+    for view_index, view in enumerate(views):
+        profile = np.asarray(view, dtype=np.float32)
+        if profile.ndim != 2 or profile.size == 0:
+            raise ValueError("Каждый вид должен быть непустым двумерным массивом.")
+        tensors.append(profile_to_tensor(profile, INPUT_SIZE, VIEW_COLORS[view_index % len(VIEW_COLORS)]))
+    return torch.stack(tensors)
+
+
+def las_to_batch(data):
+    """
+    Тензор видов дерева из содержимого LAS/LAZ-файла облака точек одного дерева.
+    При CLASSIFY_FROM_PNG виды — графики профилей matplotlib (как при обучении модели), иначе — профили в памяти.
+    """
+    las = laspy.read(io.BytesIO(data))
+    if len(las.points) == 0:
+        raise ValueError("В облаке точек нет точек.")
+    if CLASSIFY_FROM_PNG:
+        transform = build_transform(INPUT_SIZE)
+        return torch.stack([transform(image) for image in render_profile_plot_images(las.x, las.y, las.z)])
+    return profiles_to_batch(render_tree_profiles(las.x, las.y, las.z, image_size=PROFILE_IMAGE_SIZE))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Модель загружается один раз при запуске сервиса
+    torch.set_num_threads(TORCH_THREADS or os.cpu_count() or 1)
+    model = await run_in_threadpool(partial(get_model, MODEL_PATH, compiled=COMPILED_MODEL, model_name=MODEL_NAME,
+                                            image_size=INPUT_SIZE, quantization=QUANTIZATION,
+                                            calibration_folder=CALIBRATION_FOLDER, calibration_size=CALIBRATION_SIZE))
+    app.state.batcher = MicroBatcher(model, SERVICE_MAX_BATCH_SIZE, SERVICE_MAX_WAIT_MS)
+    app.state.batcher.start()
+    yield
+    await app.state.batcher.stop()
+
+
+app = FastAPI(title="Классификация деревьев", lifespan=lifespan)
+
+
+async def classify_views(tree_id, images):
+    view_classes = await app.state.batcher.predict(images)
+    return ClassificationResponse(tree_id=tree_id, tree_class=vote_tree_class(view_classes),
+                                  view_classes=view_classes)
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "model": MODEL_NAME, "input_size": INPUT_SIZE}
+
+
+@app.post("/classify/profiles", response_model=ClassificationResponse)
+async def classify_profiles(request: ProfileRequest):
+    """
+    Классификация дерева по профилям, построенным на стороне клиента.
+    """
+    if not request.views:
+        raise HTTPException(status_code=422, detail="Не передано ни одного вида дерева.")
+    try:
+        images = await run_in_threadpool(profiles_to_batch, request.views)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return await classify_views(request.tree_id, images)
+
+
+@app.post("/classify/las", response_model=ClassificationResponse)
+async def classify_las(request: Request, tree_id: Optional[int] = None):
+    """
+    Классификация дерева по облаку точек: тело запроса — содержимое LAS/LAZ-файла одного дерева.
+    """
+    data = await request.body()
+    try:
+        images = await run_in_threadpool(las_to_batch, data)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Ошибка при чтении облака точек: {e}")
+    return await classify_views(tree_id, images)
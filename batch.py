@@ -0,0 +1,374 @@
+import os
+import copy
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import laspy
+from scipy.spatial import cKDTree
+
+import config
+from rast import (read_las_file, read_las_bounds, create_raster_from_las, create_raster_from_points, create_chm_from_las,
+                  smooth_raster, save_smoothed_raster, raster_in_memory)
+from tree_detection import find_tree_tops_with_coords
+from crona import create_crown_polygons_with_attributes
+from crop import crop_point_cloud_by_polygons
+from tree_profile import add_las_attributes_and_plot
+from Efficintnet import classify_trees_and_update_shp
+from vector_io import write_vector
+
+# Подстроки в названиях LAS-файлов тайла: облако земли (рельеф) и облако леса
+GROUND_NAMES = ("relief", "ground")
+CANOPY_NAMES = ("cloud", "canopy")
+
+
+def find_las_by_names(folder, names):
+    """
+    LAS-файл папки, в названии которого есть одна из подстрок names (None, если такого нет).
+    """
+    for file_name in sorted(os.listdir(folder)):
+        if file_name.lower().endswith(".las") and any(name in file_name.lower() for name in names):
+            return os.path.join(folder, file_name)
+    return None
+
+
+def find_tile_pairs(input_path):
+    """
+    Список тайлов [(ID тайла или None, название, LAS земли, LAS леса)].
+    input_path — CSV-манифест со столбцами tile, ground, canopy (относительные пути — от папки манифеста)
+    и необязательным столбцом tile_id (постоянный целый номер тайла для глобальных ID деревьев)
+    или папка, каждая вложенная папка которой — тайл с файлами relief*.las (ground*.las) и cloud*.las (canopy*.las).
+    """
+    if os.path.isfile(input_path):
+        manifest = pd.read_csv(input_path)
+        missing = {'tile', 'ground', 'canopy'} - set(manifest.columns)
+        if missing:
+            raise ValueError(f"В манифесте тайлов нет столбцов: {', '.join(sorted(missing))}")
+        tile_ids = [None] * len(manifest)
+        if 'tile_id' in manifest.columns:
+            if manifest['tile_id'].isna().any() or not manifest['tile_id'].is_unique or (manifest['tile_id'] < 0).any():
+                raise ValueError("Столбец tile_id манифеста должен содержать различные неотрицательные целые номера.")
+            tile_ids = manifest['tile_id'].astype(np.int64).tolist()
+        manifest_folder = os.path.dirname(os.path.abspath(input_path))
+        return [(tile_id, str(row.tile), os.path.join(manifest_folder, row.ground),
+                 os.path.join(manifest_folder, row.canopy))
+                for tile_id, row in zip(tile_ids, manifest.itertuples())]
+
+    tiles = []
+    for tile_name in sorted(os.listdir(input_path)):
+        tile_folder = os.path.join(input_path, tile_name)
+        if not os.path.isdir(tile_folder):
+            continue
+        ground_path = find_las_by_names(tile_folder, GROUND_NAMES)
+        canopy_path = find_las_by_names(tile_folder, CANOPY_NAMES)
+        if ground_path is None or canopy_path is None:
+            print(f"В папке тайла {tile_folder} нет пары облаков земли и леса. Пропускаю.")
+            continue
+        tiles.append((None, tile_name, ground_path, canopy_path))
+    return tiles
+
+
+def bounds_intersect(first, second):
+    """
+    Пересечение прямоугольников (min_x, max_x, min_y, max_y).
+    """
+    return first[0] <= second[1] and first[1] >= second[0] and first[2] <= second[3] and first[3] >= second[2]
+
+
+def write_buffered_las(las_paths, bounds, output_path, chunk_size=5_000_000):
+    """
+    Облако точек тайла с буфером: точки LAS-файлов las_paths (тайл и его соседи) внутри
+    bounds (min_x, max_x, min_y, max_y) в одном файле с форматом точек первого файла.
+    Масштаб координат — наименьший среди файлов, смещение — от нижнего угла bounds,
+    поэтому целочисленные координаты не теряют точность и не переполняют int32.
+    Атрибуты точек, которых нет в формате первого файла, не переносятся (выводится сообщение).
+    """
+    min_x, max_x, min_y, max_y = bounds
+    headers = []
+    for las_path in las_paths:
+        with laspy.open(las_path) as las_file:
+            headers.append(las_file.header)
+    header = copy.deepcopy(headers[0])
+    header.scales = np.min([h.scales for h in headers], axis=0)
+    min_z = min(h.mins[2] for h in headers)
+    max_z = max(h.maxs[2] for h in headers)
+    header.offsets = np.array([min_x, min_y, min_z])
+    extents = np.array([max_x - min_x, max_y - min_y, max_z - min_z]) / header.scales
+    if np.any(extents > np.iinfo(np.int32).max):
+        raise ValueError(f"Координаты облака тайла не помещаются в int32 при масштабе {header.scales}: {output_path}")
+
+    with laspy.open(output_path, mode="w", header=header) as writer:
+        for las_path, las_header in zip(las_paths, headers):
+            dropped = [name for name in las_header.point_format.dimension_names
+                       if name not in header.point_format.dimension_names]
+            if dropped:
+                print(f"Формат точек {las_header.point_format.id} файла {las_path} отличается от формата "
+                      f"{header.point_format.id}, атрибуты не переносятся: {', '.join(dropped)}")
+            with laspy.open(las_path) as las_file:
+                for chunk in las_file.chunk_iterator(chunk_size):
+                    inside = ((chunk.x >= min_x) & (chunk.x <= max_x) & (chunk.y >= min_y) & (chunk.y <= max_y))
+                    if not inside.any():
+                        continue
+                    chunk = chunk[inside]
+                    records = laspy.ScaleAwarePointRecord.zeros(len(chunk), header=header)
+                    for name in records.point_format.dimension_names:
+                        if name not in ("X", "Y", "Z") and name in chunk.point_format.dimension_names:
+                            records[name] = chunk[name]
+                    records.x, records.y, records.z = chunk.x, chunk.y, chunk.z
+                    writer.write_points(records)
+    return output_path
+
+
+def rasterize_las(las_path, output_path, reduction):
+    """
+    Растр высот LAS-файла тайла (потоково, если агрегация это позволяет) в памяти (см. raster_in_memory).
+    """
+    if reduction == "percentile" or config.CHUNK_SIZE is None:
+        points = read_las_file(las_path)
+        result = None if points is None else create_raster_from_points(
+            points, output_path, pixel_size=config.PIXEL_SIZE, reduction=reduction,
+            percentile=config.GROUND_PERCENTILE, raster_format=config.RASTER_FORMAT)
+    else:
+        result = create_raster_from_las(las_path, output_path, pixel_size=config.PIXEL_SIZE,
+                                        chunk_size=config.CHUNK_SIZE, reduction=reduction,
+                                        raster_format=config.RASTER_FORMAT)
+    if result is None:
+        raise ValueError(f"Не удалось создать растр: {las_path}")
+    grid_z, bounds, pixel_size = result
+    return raster_in_memory(grid_z, (bounds[0], pixel_size, 0, bounds[3], 0, -pixel_size))
+
+
+def process_tile(task):
+    """
+    Этапы 1–6 для одного тайла в процессе-обработчике с явными путями тайла вместо путей из config.py.
+    Облака тайла дополняются точками соседних тайлов в пределах buffered_bounds (временные LAS-файлы),
+    поэтому кроны деревьев у границы тайла не обрезаются; в слое тайла остаются только деревья,
+    вершины которых лежат в границах тайла core_bounds (с допуском margin метров).
+    Промежуточные файлы записываются в папку тайла только при SAVE_CHECKPOINTS,
+    итоговый слой крон тайла записывается всегда.
+
+    :return: (номер тайла, слой крон тайла с классами деревьев).
+    """
+    (tile_index, tile_name, ground_paths, canopy_paths, core_bounds, buffered_bounds, margin,
+     tile_folder, torch_threads) = task
+    os.makedirs(tile_folder, exist_ok=True)
+    if len(canopy_paths) == 1:
+        return tile_index, process_tile_clouds(tile_name, ground_paths[0], canopy_paths[0], core_bounds, margin,
+                                               tile_folder, torch_threads)
+
+    with tempfile.TemporaryDirectory(dir=tile_folder) as buffer_folder:
+        print(f"\nТайл {tile_name}: облака точек с буфером из {len(canopy_paths) - 1} соседних тайлов...")
+        chunk_size = config.CHUNK_SIZE or 5_000_000
+        ground_path = write_buffered_las(ground_paths, buffered_bounds, os.path.join(buffer_folder, "relief.las"),
+                                         chunk_size)
+        canopy_path = write_buffered_las(canopy_paths, buffered_bounds, os.path.join(buffer_folder, "cloud.las"),
+                                         chunk_size)
+        return tile_index, process_tile_clouds(tile_name, ground_path, canopy_path, core_bounds, margin,
+                                               tile_folder, torch_threads)
+
+
+def process_tile_clouds(tile_name, ground_path, canopy_path, core_bounds, margin, tile_folder, torch_threads):
+    """
+    Этапы 1–6 по облакам земли и леса тайла (с буфером, см. process_tile).
+    """
+    save = config.SAVE_CHECKPOINTS
+
+    def checkpoint(name):
+        return os.path.join(tile_folder, name) if save else None
+
+    print(f"\nТайл {tile_name}: создание растров...")
+    relief = rasterize_las(ground_path, checkpoint("relief_raster.tif"), config.GROUND_REDUCTION)
+    if config.USE_CHM:
+        chm = create_chm_from_las(canopy_path, relief, checkpoint("chm.tif"), sigma=config.SIGMA,
+                                  chunk_size=config.CHUNK_SIZE or 5_000_000, reduction=config.CANOPY_REDUCTION,
+                                  percentile=config.GROUND_PERCENTILE, smooth_block_size=config.SMOOTH_BLOCK_SIZE,
+                                  raster_format=config.RASTER_FORMAT)
+        if chm is None:
+            raise ValueError(f"Не удалось создать модель высот полога: {canopy_path}")
+        raster_inputs = {'chm_raster': chm}
+    else:
+        trees = rasterize_las(canopy_path, None, config.CANOPY_REDUCTION)
+        trees['data'] = smooth_raster(trees['data'], sigma=config.SIGMA, block_size=config.SMOOTH_BLOCK_SIZE)
+        if save:
+            save_smoothed_raster(trees['data'], trees['transform'], checkpoint("trees_smoothed.tif"),
+                                 raster_format=config.RASTER_FORMAT)
+        raster_inputs = {'relief_raster': relief, 'trees_raster': trees}
+
+    print(f"\nТайл {tile_name}: поиск вершин деревьев...")
+    tree_tops_gdf = find_tree_tops_with_coords(
+        output_path=checkpoint("tree_tops" + config.VECTOR_EXTENSION), workers=1,
+        cluster_tile_size=config.CLUSTER_TILE_SIZE, save_output=save, **raster_inputs
+    )
+    if tree_tops_gdf.empty:
+        print(f"Тайл {tile_name}: деревья не найдены.")
+        return tree_tops_gdf
+
+    crowns_gdf = create_crown_polygons_with_attributes(
+        None, checkpoint("tree_crowns_with_attributes" + config.VECTOR_EXTENSION), k=config.k,
+        points_gdf=tree_tops_gdf, save_output=save
+    )
+
+    # Деревья буфера принадлежат соседним тайлам: кроны строятся по всем вершинам, остаются вершины тайла
+    min_x, max_x, min_y, max_y = core_bounds
+    owned = (crowns_gdf['x_coord'].between(min_x - margin, max_x + margin)
+             & crowns_gdf['y_coord'].between(min_y - margin, max_y + margin))
+    crowns_gdf = crowns_gdf[owned]
+    if crowns_gdf.empty:
+        print(f"Тайл {tile_name}: деревья не найдены.")
+        return crowns_gdf
+    crop_folder = os.path.join(tile_folder, "Point Cloud Crop")
+    tree_points = crop_point_cloud_by_polygons(
+        None, canopy_path, crop_folder, chunk_size=config.CHUNK_SIZE,
+        workers=1, compress=config.CROP_COMPRESS, polygons_gdf=crowns_gdf, save_files=save
+    )
+    profile_folder = os.path.join(tile_folder, "Tree_profile")
+    crowns_gdf, profiles = add_las_attributes_and_plot(
+        None, crop_folder, checkpoint("tree_crowns_with_height_las" + config.VECTOR_EXTENSION),
+        profile_folder, tree_points=tree_points, save_png=config.SAVE_PROFILE_PNG or config.CLASSIFY_FROM_PNG,
+        image_size=config.PROFILE_IMAGE_SIZE, plot_workers=1, crowns_gdf=crowns_gdf, save_output=save
+    )
+
+    print(f"\nТайл {tile_name}: классификация деревьев...")
+    crowns_gdf = classify_trees_and_update_shp(
+        config.MODEL_PATH, profile_folder, None,
+        os.path.join(tile_folder, "tree_crowns_with_class" + config.VECTOR_EXTENSION),
+        batch_size=config.BATCH_SIZE, num_workers=0, num_threads=torch_threads,
+        profiles=None if config.CLASSIFY_FROM_PNG else profiles,
+        compiled=config.COMPILED_MODEL, model_name=config.MODEL_NAME, image_size=config.INPUT_SIZE,
+        quantization=config.QUANTIZATION, calibration_folder=config.CALIBRATION_FOLDER,
+        calibration_size=config.CALIBRATION_SIZE, crowns_gdf=crowns_gdf
+    )
+    return crowns_gdf
+
+
+def assign_global_ids(crowns_gdf, tile_key, tile_name, id_stride):
+    """
+    Глобально уникальные ID деревьев: tile_key * id_stride + ID дерева в тайле, где tile_key —
+    tile_id из манифеста (постоянный) или номер тайла в списке + 1 (ID уникальны только в пределах запуска).
+    ID дерева в тайле и название тайла сохраняются в атрибутах local_id и tile.
+    """
+    crowns_gdf = crowns_gdf.copy()
+    if len(crowns_gdf) and crowns_gdf['tree_id'].max() >= id_stride:
+        raise ValueError(f"В тайле {tile_name} больше {id_stride - 1} деревьев: увеличьте BATCH_ID_STRIDE.")
+    crowns_gdf['local_id'] = crowns_gdf['tree_id']
+    crowns_gdf['tree_id'] = tile_key * id_stride + crowns_gdf['tree_id'].astype(np.int64)
+    crowns_gdf['tile'] = tile_name
+    return crowns_gdf
+
+
+def merge_border_trees(crowns_gdf, tile_bounds, merge_distance=2.0):
+    """
+    Объединение деревьев, найденных в нескольких тайлах (у общей границы и в перекрытиях тайлов).
+    Вершины разных тайлов ближе merge_distance метров считаются одним деревом; из каждой такой группы
+    остается дерево, вершина которого дальше всего от края своего тайла (tile_bounds — {название тайла:
+    (min_x, max_x, min_y, max_y)}), т.е. обработанное с наибольшим запасом буфера.
+    """
+    if len(crowns_gdf) < 2:
+        return crowns_gdf
+    coords = np.column_stack((crowns_gdf['x_coord'], crowns_gdf['y_coord']))
+    tiles = crowns_gdf['tile'].to_numpy()
+    bounds = np.array([tile_bounds[tile_name] for tile_name in tiles], dtype=np.float64)
+    edge_distance = np.min(np.column_stack((coords[:, 0] - bounds[:, 0], bounds[:, 1] - coords[:, 0],
+                                            coords[:, 1] - bounds[:, 2], bounds[:, 3] - coords[:, 1])), axis=1)
+
+    # Пары близких вершин из разных тайлов
+    pairs = cKDTree(coords).query_pairs(merge_distance, output_type='ndarray')
+    pairs = pairs[tiles[pairs[:, 0]] != tiles[pairs[:, 1]]]
+    neighbors = defaultdict(list)
+    for first, second in pairs:
+        neighbors[first].append(second)
+        neighbors[second].append(first)
+
+    # Деревья перебираются от самого удаленного от края тайла: оставленное дерево исключает своих соседей
+    removed = np.zeros(len(crowns_gdf), dtype=bool)
+    for position in np.argsort(-edge_distance, kind='stable'):
+        if removed[position]:
+            continue
+        for neighbor in neighbors.get(position, ()):
+            removed[neighbor] = True
+
+    print(f"Объединено деревьев на границах тайлов: {int(removed.sum())}")
+    return crowns_gdf[~removed].reset_index(drop=True)
+
+
+def run_batch(input_path, output_folder, output_path=None, workers=2, id_stride=1_000_000, merge_distance=2.0,
+              tile_buffer=20.0):
+    """
+    Пакетная обработка нескольких сцен (тайлов облаков точек): все этапы для каждого тайла
+    выполняются параллельно в пуле из workers процессов по облакам тайла с буфером tile_buffer метров
+    из соседних тайлов, затем слои крон тайлов объединяются в один слой с глобальными ID
+    (см. assign_global_ids), а дубликаты деревьев на границах тайлов удаляются (см. merge_border_trees).
+
+    :param input_path: Папка тайлов или CSV-манифест пар облаков земли и леса (см. find_tile_pairs).
+    :param output_folder: Папка результатов; результаты тайла — во вложенной папке с названием тайла.
+    :param output_path: Путь к объединенному слою крон (None — только возврат результата).
+    :return: Объединенный GeoDataFrame крон с классами деревьев.
+    """
+    tiles = find_tile_pairs(input_path)
+    if not tiles:
+        print(f"Тайлы для обработки не найдены: {input_path}")
+        return None
+    print(f"Найдено тайлов: {len(tiles)}")
+    if len({tile_name for _, tile_name, _, _ in tiles}) != len(tiles):
+        raise ValueError("Названия тайлов должны быть различными (по ним называются папки результатов).")
+
+    if any(tile_id is None for tile_id, _, _, _ in tiles):
+        print("ID тайлов не заданы (столбец tile_id манифеста): глобальные ID деревьев зависят от порядка тайлов "
+              "и уникальны только в пределах одного запуска.")
+
+    # Потоки torch делятся между одновременно работающими процессами
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tiles)))
+    torch_threads = max(1, (config.TORCH_THREADS or os.cpu_count() or 1) // workers)
+
+    # Границы тайлов по заголовкам облаков леса; в буфер тайла попадают точки пересекающихся с ним соседей
+    tile_bounds = {tile_name: read_las_bounds(canopy_path) for _, tile_name, _, canopy_path in tiles}
+    tasks = []
+    for tile_index, (_, tile_name, ground_path, canopy_path) in enumerate(tiles):
+        min_x, max_x, min_y, max_y = tile_bounds[tile_name]
+        buffered_bounds = (min_x - tile_buffer, max_x + tile_buffer, min_y - tile_buffer, max_y + tile_buffer)
+        ground_paths, canopy_paths = [ground_path], [canopy_path]
+        for _, neighbor_name, neighbor_ground, neighbor_canopy in tiles:
+            if neighbor_name != tile_name and bounds_intersect(tile_bounds[neighbor_name], buffered_bounds):
+                ground_paths.append(neighbor_ground)
+                canopy_paths.append(neighbor_canopy)
+        tasks.append((tile_index, tile_name, ground_paths, canopy_paths, tile_bounds[tile_name], buffered_bounds,
+                      merge_distance, os.path.join(output_folder, tile_name), torch_threads))
+
+    tile_layers = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_tile, task): task for task in tasks}
+        for future in as_completed(futures):
+            tile_index, tile_name = futures[future][:2]
+            tile_id = tiles[tile_index][0]
+            try:
+                _, crowns_gdf = future.result()
+                if not crowns_gdf.empty:
+                    tile_key = tile_id if tile_id is not None else tile_index + 1
+                    tile_layers[tile_index] = assign_global_ids(crowns_gdf, tile_key, tile_name, id_stride)
+            except Exception as e:
+                print(f"Ошибка при обработке тайла {tile_name}: {e}")
+                continue
+            print(f"Тайл {tile_name} обработан ({len(tile_layers)} из {len(tasks)} с деревьями).")
+
+    if not tile_layers:
+        print("Ни в одном тайле не найдено деревьев.")
+        return None
+
+    # Объединение слоев тайлов в порядке тайлов и удаление дубликатов на границах
+    layers = [tile_layers[tile_index] for tile_index in sorted(tile_layers)]
+    merged_gdf = gpd.GeoDataFrame(pd.concat(layers, ignore_index=True), crs=layers[0].crs)
+    merged_gdf = merge_border_trees(merged_gdf, tile_bounds, merge_distance)
+
+    if output_path:
+        write_vector(merged_gdf, output_path)
+        print(f"Объединенный слой крон сохранен: {output_path}")
+    print(f"Всего деревьев: {len(merged_gdf)}")
+    return merged_gdf
+
+# Пример использования
+if __name__ == "__main__":
+    run_batch(config.BATCH_INPUT_PATH, config.BATCH_OUTPUT_FOLDER, config.BATCH_OUTPUT_PATH,
+              workers=config.BATCH_WORKERS, id_stride=config.BATCH_ID_STRIDE,
+              merge_distance=config.BATCH_MERGE_DISTANCE, tile_buffer=config.BATCH_TILE_BUFFER)
@@ -0,0 +1,221 @@
+import os
+import time
+import tempfile
+import torch
+import laspy
+import pandas as pd
+from torch.utils.data import Dataset, DataLoader
+from PIL import Image
+from Efficintnet import (CLASS_MAPPING, VIEW_COLORS, build_transform, get_model, load_model, profile_to_tensor,
+                         vote_tree_class)
+from tree_profile import render_tree_profiles, render_profile_plot_images
+
+
+def labeled_files(test_folder, extensions):
+    """
+    Файлы с известными классами: {test_folder}/{класс}/*, где класс — название из CLASS_MAPPING
+    ("ель", "береза", "сосна") или его номер. Возвращает список (путь, номер класса).
+    """
+    samples = []
+    for label, class_name in CLASS_MAPPING.items():
+        for folder_name in (class_name, str(label)):
+            class_folder = os.path.join(test_folder, folder_name)
+            if not os.path.isdir(class_folder):
+                continue
+            for file_name in sorted(os.listdir(class_folder)):
+                if file_name.lower().endswith(extensions):
+                    samples.append((os.path.join(class_folder, file_name), label))
+    if not samples:
+        print(f"Предупреждение: в папке {test_folder} не найдено файлов {extensions} "
+              f"классов {list(CLASS_MAPPING.values())}.")
+    return samples
+
+
+class LabeledProfileDataset(Dataset):
+    """
+    Отложенная выборка профилей деревьев с известными классами.
+    Структура папки: {test_folder}/{класс}/*.png (см. labeled_files).
+    """
+
+    def __init__(self, test_folder, image_size=600):
+        self.transform = build_transform(image_size)
+        self.samples = labeled_files(test_folder, (".png", ".jpg", ".jpeg"))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        image_path, label = self.samples[index]
+        return self.transform(Image.open(image_path).convert("RGB")), label
+
+
+def benchmark_configuration(model_path, test_folder, model_name='efficientnet_b7', image_size=600,
+                            quantization=None, calibration_folder=None, calibration_size=64,
+                            cache_folder=None, batch_size=16, num_workers=4):
+    """
+    Точность и скорость классификации одной конфигурации модели на отложенной выборке.
+    Время считается только для прямого прохода модели (без чтения изображений),
+    первый батч используется для прогрева и в замер не входит.
+    Статическое квантование калибруется только по отдельной выборке calibration_folder,
+    скомпилированные модели сохраняются в cache_folder, а не в рабочий кэш рядом с файлом весов.
+    """
+    if quantization == "static" and calibration_folder:
+        folders = [os.path.abspath(calibration_folder), os.path.abspath(test_folder)]
+        if os.path.commonpath(folders) in folders:
+            raise ValueError("Выборка для калибровки не должна совпадать с отложенной выборкой или входить в нее.")
+
+    dataset = LabeledProfileDataset(test_folder, image_size)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    model = get_model(model_path, compiled=True, model_name=model_name, image_size=image_size,
+                      quantization=quantization, calibration_folder=calibration_folder,
+                      calibration_size=calibration_size, cache_folder=cache_folder)
+
+    n_correct, n_images, n_timed, elapsed = 0, 0, 0, 0.0
+    with torch.inference_mode():
+        for batch_index, (images, labels) in enumerate(loader):
+            start = time.perf_counter()
+            predicted = model(images).argmax(dim=1)
+            if batch_index > 0:
+                elapsed += time.perf_counter() - start
+                n_timed += len(images)
+            n_correct += int((predicted == labels).sum())
+            n_images += len(images)
+
+    return {
+        'model_name': model_name,
+        'image_size': image_size,
+        'quantization': quantization or "нет",
+        'input': "PNG",
+        'images': n_images,
+        'accuracy': n_correct / n_images if n_images else float("nan"),
+        'images_per_s': n_timed / elapsed if elapsed > 0 else float("nan"),
+        'ms_per_image': 1000 * elapsed / n_timed if n_timed else float("nan")
+    }
+
+
+class LabeledTreeCloudDataset(Dataset):
+    """
+    Облака точек деревьев с известными классами ({test_folder}/{класс}/*.las, см. labeled_files).
+    Элемент — оба вида дерева в двух представлениях: графики профилей PNG (как при обучении модели)
+    и профили, построенные в памяти (tree_profile.rasterize_profile), и номер класса.
+    """
+
+    def __init__(self, test_folder, image_size=600, profile_image_size=600):
+        self.image_size = image_size
+        self.profile_image_size = profile_image_size
+        self.transform = build_transform(image_size)
+        self.samples = labeled_files(test_folder, (".las", ".laz"))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        las_path, label = self.samples[index]
+        las = laspy.read(las_path)
+        png_views = torch.stack([self.transform(image) for image in render_profile_plot_images(las.x, las.y, las.z)])
+        profiles = render_tree_profiles(las.x, las.y, las.z, image_size=self.profile_image_size)
+        array_views = torch.stack([profile_to_tensor(profile, self.image_size, color)
+                                   for profile, color in zip(profiles, VIEW_COLORS)])
+        return png_views, array_views, label
+
+
+def compare_profile_inputs(model_path, test_folder, model_name='efficientnet_b7', image_size=600,
+                           profile_image_size=600, num_workers=4, report_path=None):
+    """
+    Сравнение точности классификации по графикам профилей PNG и по профилям в памяти на одних
+    и тех же деревьях с известными классами. Перед переключением конвейера на профили в памяти
+    (config.CLASSIFY_FROM_PNG = False) точность по ним не должна быть ниже точности по PNG.
+    Модель загружается без кэша TorchScript конвейера.
+
+    :return: Таблица по деревьям (pandas.DataFrame) с классами по обоим представлениям.
+    """
+    model = load_model(model_path, model_name)
+    dataset = LabeledTreeCloudDataset(test_folder, image_size, profile_image_size)
+    loader = DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers)
+
+    rows = []
+    with torch.inference_mode():
+        for (las_path, label), (png_views, array_views, _) in zip(dataset.samples, loader):
+            rows.append({
+                'las_path': las_path,
+                'class': CLASS_MAPPING[label],
+                'png_class': vote_tree_class(model(png_views).argmax(dim=1).tolist()),
+                'array_class': vote_tree_class(model(array_views).argmax(dim=1).tolist())
+            })
+
+    report = pd.DataFrame(rows, columns=['las_path', 'class', 'png_class', 'array_class'])
+    if len(report):
+        print(f"Деревьев: {len(report)}\n"
+              f"Точность по PNG: {(report['png_class'] == report['class']).mean():.3f}\n"
+              f"Точность по профилям в памяти: {(report['array_class'] == report['class']).mean():.3f}\n"
+              f"Совпадение классов: {(report['png_class'] == report['array_class']).mean():.3f}")
+    if report_path:
+        report.to_csv(report_path, index=False)
+        print(f"Отчет сохранен: {report_path}")
+    return report
+
+
+def benchmark_classifier(configurations, test_folder, report_path=None, calibration_folder=None,
+                         cache_folder=None, batch_size=16, num_workers=4, num_threads=None):
+    """
+    Сравнение конфигураций классификатора (архитектура, размер входа, квантование)
+    по точности и скорости на CPU на отложенной выборке профилей деревьев.
+    Оцениваются графики профилей PNG; если конвейер классифицирует профили в памяти
+    (config.CLASSIFY_FROM_PNG = False), их точность проверяется отдельно (compare_profile_inputs).
+
+    :param configurations: Список словарей с ключами model_path, model_name, image_size, quantization.
+    :param test_folder: Папка отложенной выборки ({класс}/*.png).
+    :param report_path: Путь к CSV-файлу отчета (None — только вывод в консоль).
+    :param calibration_folder: Папка выборки для калибровки статического квантования
+                               (обязательна для quantization="static", отдельно от test_folder).
+    :param cache_folder: Папка для скомпилированных моделей (None — временная папка).
+    :return: Таблица результатов (pandas.DataFrame).
+    """
+    torch.set_num_threads(num_threads or os.cpu_count() or 1)
+    cache_folder = cache_folder or tempfile.mkdtemp(prefix="benchmark_models_")
+
+    results = []
+    for configuration in configurations:
+        print(f"\nКонфигурация: {configuration}")
+        try:
+            result = benchmark_configuration(test_folder=test_folder, calibration_folder=calibration_folder,
+                                             cache_folder=cache_folder, batch_size=batch_size,
+                                             num_workers=num_workers, **configuration)
+        except Exception as e:
+            print(f"Ошибка при оценке конфигурации {configuration}: {e}")
+            continue
+        print(f"Точность: {result['accuracy']:.3f}, скорость: {result['images_per_s']:.1f} изобр./с")
+        results.append(result)
+
+    report = pd.DataFrame(results)
+    print("\nТочность и скорость классификации на CPU (входы — графики профилей PNG):")
+    print(report.to_string(index=False))
+    if report_path:
+        report.to_csv(report_path, index=False)
+        print(f"Отчет сохранен: {report_path}")
+    return report
+
+# Пример использования
+if __name__ == "__main__":
+    model_folder = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\model"
+    test_folder = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Tree_profile_test"
+    calibration_folder = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Tree_profile_calibration"
+    report_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\model\benchmark.csv"
+
+    configurations = [
+        {'model_path': os.path.join(model_folder, "efficientnet_b7.pth"), 'model_name': 'efficientnet_b7',
+         'image_size': 600, 'quantization': None},
+        {'model_path': os.path.join(model_folder, "efficientnet_b3.pth"), 'model_name': 'efficientnet_b3',
+         'image_size': 300, 'quantization': None},
+        {'model_path': os.path.join(model_folder, "efficientnet_b3.pth"), 'model_name': 'efficientnet_b3',
+         'image_size': 300, 'quantization': 'static'},
+        {'model_path': os.path.join(model_folder, "efficientnet_b0.pth"), 'model_name': 'efficientnet_b0',
+         'image_size': 224, 'quantization': 'static'},
+    ]
+    benchmark_classifier(configurations, test_folder, report_path, calibration_folder=calibration_folder)
+
+    # Точность по графикам PNG и по профилям в памяти на облаках деревьев с известными классами
+    test_cloud_folder = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Point Cloud test"
+    compare_profile_inputs(os.path.join(model_folder, "efficientnet_b7.pth"), test_cloud_folder,
+                           report_path=os.path.join(model_folder, "profile_inputs.csv"))
@@ -0,0 +1,137 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def build_tile_index(coords, tile_size):
+    """
+    Разбиение точек на квадратные тайлы размером tile_size.
+    Возвращает параметры сетки тайлов, номер тайла каждой точки и порядок точек по тайлам.
+    """
+    origin = coords.min(axis=0)
+    tile_xy = ((coords - origin) // tile_size).astype(np.int64)
+    n_tile_cols = int(tile_xy[:, 0].max()) + 1
+    keys = tile_xy[:, 1] * n_tile_cols + tile_xy[:, 0]
+    order = np.argsort(keys, kind="stable")
+    return {
+        'n_tile_cols': n_tile_cols,
+        'keys': keys,
+        'sorted_keys': keys[order],
+        'order': order
+    }
+
+
+def tile_members(index, key):
+    """
+    Индексы точек, попавших в тайл с номером key.
+    """
+    start = np.searchsorted(index['sorted_keys'], key, side="left")
+    end = np.searchsorted(index['sorted_keys'], key, side="right")
+    return index['order'][start:end]
+
+
+def tile_with_halo(index, coords, key, eps):
+    """
+    Индексы точек тайла вместе с точками соседних тайлов, лежащими не дальше eps от его границ.
+    """
+    n_tile_cols = index['n_tile_cols']
+    tile_row, tile_col = divmod(key, n_tile_cols)
+    inner = tile_members(index, key)
+    inner_coords = coords[inner]
+    low, high = inner_coords.min(axis=0) - eps, inner_coords.max(axis=0) + eps
+
+    neighbours = [inner]
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            if (dr or dc) and 0 <= tile_col + dc < n_tile_cols and tile_row + dr >= 0:
+                members = tile_members(index, (tile_row + dr) * n_tile_cols + tile_col + dc)
+                member_coords = coords[members]
+                near = np.all((member_coords >= low) & (member_coords <= high), axis=1)
+                neighbours.append(members[near])
+    return inner, np.concatenate(neighbours)
+
+
+def dbscan_tiled(coords, eps, min_samples=5, tile_size=50.0):
+    """
+    Кластеризация DBSCAN по тайлам с объединением кластеров через границы тайлов.
+    Ядровые точки и связи между ними считаются в KD-дереве тайла с буфером eps,
+    поэтому память определяется размером тайла, а не всей сценой.
+    Кластеры ядровых точек совпадают с sklearn.cluster.DBSCAN; граничная точка
+    относится к кластеру ближайшей ядровой точки. Шум получает метку -1.
+
+    :param coords: Массив координат (N, 2).
+    :param eps: Радиус окрестности.
+    :param min_samples: Минимальное число точек в окрестности (включая саму точку) для ядровой точки.
+    :param tile_size: Размер тайла (не меньше eps).
+    :return: Массив меток кластеров, пронумерованных в порядке первого появления.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    labels = np.full(len(coords), -1, dtype=np.int64)
+    if len(coords) == 0:
+        return labels
+
+    tile_size = max(tile_size, eps)
+    index = build_tile_index(coords, tile_size)
+    tile_keys = np.unique(index['keys'])
+
+    # Проход 1: ядровые точки (число соседей в радиусе eps с учетом соседних тайлов)
+    is_core = np.zeros(len(coords), dtype=bool)
+    for key in tile_keys:
+        inner, local = tile_with_halo(index, coords, key, eps)
+        tree = cKDTree(coords[local])
+        counts = tree.query_ball_point(coords[inner], r=eps, return_length=True)
+        is_core[inner] = counts >= min_samples
+
+    # Проход 2: компоненты связности ядровых точек внутри каждого тайла с буфером.
+    # Каждая компонента тайла — узел; узлы, содержащие одну и ту же точку, объединяются.
+    home_node = np.full(len(coords), -1, dtype=np.int64)
+    link_nodes, link_points = [], []
+    n_nodes = 0
+    for key in tile_keys:
+        inner, local = tile_with_halo(index, coords, key, eps)
+        local = local[is_core[local]]
+        if len(local) == 0:
+            continue
+        pairs = cKDTree(coords[local]).query_pairs(eps, output_type="ndarray")
+        graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+                           shape=(len(local), len(local)))
+        _, components = connected_components(graph, directed=False)
+        nodes = components + n_nodes
+        n_nodes = nodes.max() + 1
+
+        is_home = index['keys'][local] == key
+        home_node[local[is_home]] = nodes[is_home]
+        link_nodes.append(nodes[~is_home])
+        link_points.append(local[~is_home])
+
+    if n_nodes == 0:
+        return labels
+
+    link_nodes = np.concatenate(link_nodes)
+    link_points = np.concatenate(link_points)
+    graph = coo_matrix((np.ones(len(link_nodes), dtype=np.int8), (link_nodes, home_node[link_points])),
+                       shape=(n_nodes, n_nodes))
+    _, node_labels = connected_components(graph, directed=False)
+    labels[is_core] = node_labels[home_node[is_core]]
+
+    # Проход 3: граничные точки получают метку ближайшей ядровой точки в радиусе eps
+    for key in tile_keys:
+        inner, local = tile_with_halo(index, coords, key, eps)
+        border = inner[~is_core[inner]]
+        core = local[is_core[local]]
+        if len(border) == 0 or len(core) == 0:
+            continue
+        # distance_upper_bound строгий, поэтому граница eps включается через nextafter
+        distances, nearest = cKDTree(coords[core]).query(coords[border], k=1,
+                                                         distance_upper_bound=np.nextafter(eps, np.inf))
+        found = np.isfinite(distances)
+        labels[border[found]] = labels[core[nearest[found]]]
+
+    # Перенумерация кластеров в порядке первого появления точек
+    clustered = labels >= 0
+    unique_labels, first_index = np.unique(labels[clustered], return_index=True)
+    ranks = np.empty(len(unique_labels), dtype=np.int64)
+    ranks[np.argsort(first_index)] = np.arange(len(unique_labels))
+    labels[clustered] = ranks[np.searchsorted(unique_labels, labels[clustered])]
+    return labels
@@ -5,28 +5,79 @@ FOREST_OUTPUT_FOLDER = r"C:\Работа\Магистратура\Четверт
 POINT_CLOUD_CROP_FOLDER = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Point Cloud Crop"
 TREE_PROFILE_FOLDER = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Tree_profile"
 
+# Формат промежуточных векторных слоев между этапами: ".parquet" (GeoParquet), ".fgb" (FlatGeobuf) или ".shp"
+VECTOR_EXTENSION = ".parquet"
+
 relief_raster_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\GeoTIFF рельеф\relief_raster.tif"
 trees_raster_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\GeoTIFF лес\Cloud_smoothed.tif"
-output_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_tops.shp"
-input_points_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_tops.shp"
-output_polygons_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_attributes.shp"
-input_shp_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_attributes.shp"
+chm_raster_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\GeoTIFF лес\chm.tif"  # Модель высот полога: этап 1 записывает ее по этому пути
+output_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_tops" + VECTOR_EXTENSION
+input_points_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_tops" + VECTOR_EXTENSION
+output_polygons_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_attributes" + VECTOR_EXTENSION
+input_shp_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_attributes" + VECTOR_EXTENSION
 input_las_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Point Cloud\Cloud.las"
 output_folder = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Point Cloud Crop"
-output_crowns_shp = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_attributes.shp"
+output_crowns_shp = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_attributes" + VECTOR_EXTENSION
 input_cropped_folder = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Point Cloud Crop"
-output_cropped_folder = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_height_las.shp"
+output_cropped_folder = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_height_las" + VECTOR_EXTENSION
 output_tree_profile_folder = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Tree_profile"
+SAVE_CHECKPOINTS = True  # Сохранять промежуточные результаты этапов (растры, слои, облака деревьев) на диск
+PIPELINE_MANIFEST_PATH = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\pipeline_manifest.json"  # Манифест инкрементального запуска этапов
 
 # Модель классификации
 MODEL_PATH = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\model\efficientnet_b7.pth"
 IMAGE_FOLDER = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Tree_profile"
-SHP_PATH = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_height_las.shx"
-OUTPUT_SHP_PATH = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_class.shp"
+SHP_PATH = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_height_las" + VECTOR_EXTENSION
+OUTPUT_SHP_PATH = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_class" + VECTOR_EXTENSION
+EXPORT_SHP_PATH = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_crowns_with_class.shp"  # Итоговый Shapefile (None — не экспортировать)
+SAVE_PROFILE_PNG = False  # Сохранять профили деревьев в PNG (отладочный вывод)
+# Классифицировать по графикам профилей PNG, на которых обучена модель. False — по профилям в памяти
+# (без PNG, быстрее); перед переключением сравнить точность: benchmark_classifier.compare_profile_inputs
+CLASSIFY_FROM_PNG = True
+PROFILE_IMAGE_SIZE = 600  # Размер профиля дерева в пикселях (вход классификатора)
+BATCH_SIZE = 8        # Количество деревьев (по два вида) в батче классификации
+LOADER_WORKERS = 4    # Число процессов DataLoader для чтения и масштабирования изображений
+TORCH_THREADS = None  # Число потоков torch на CPU (None — все ядра)
+COMPILED_MODEL = True  # Использовать скомпилированную модель TorchScript (кэшируется рядом с файлом весов)
+MODEL_NAME = "efficientnet_b7"  # Архитектура timm: "efficientnet_b0" ... "efficientnet_b3", "efficientnet_b7" (веса MODEL_PATH должны ей соответствовать)
+INPUT_SIZE = 600      # Размер входа классификатора (B0 — 224, B1 — 240, B2 — 260, B3 — 300, B7 — 600)
+# Квантование int8 на CPU: None или "static" (вся сеть, с калибровкой по CALIBRATION_FOLDER).
+QUANTIZATION = None
+CALIBRATION_FOLDER = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Tree_profile_calibration"  # Фиксированная выборка профилей PNG для калибровки (не из обрабатываемого участка)
+CALIBRATION_SIZE = 64  # Число изображений выборки для калибровки
+SERVICE_MAX_BATCH_SIZE = 16  # Сервис классификации: максимальное число видов в одном прямом проходе
+SERVICE_MAX_WAIT_MS = 20     # Сервис классификации: максимальное ожидание заполнения батча (мс)
 
 # Параметры обработки
 PIXEL_SIZE = 0.1  # Размер пикселя в метрах
 SIGMA = 1.5       # Параметр сглаживания
+CHUNK_SIZE = 5_000_000  # Количество точек, читаемых из LAS за один раз (None — чтение файла целиком)
+CANOPY_REDUCTION = "max"  # Агрегация высот в пикселе для растра леса: "max", "min", "mean", "percentile"
+GROUND_REDUCTION = "min"  # Агрегация высот в пикселе для растра рельефа
+GROUND_PERCENTILE = 5     # Процентиль для рельефа при GROUND_REDUCTION = "percentile"
+TILE_SIZE = None   # Размер тайла растра в пикселях, например 2048 (тайловый режим без визуализации растров; None — растр целиком)
+TILE_BUFFER = 64   # Перекрытие тайлов в пикселях (не меньше 4 * SIGMA)
+N_WORKERS = None   # Число процессов для параллельной обработки (None — все ядра)
+SMOOTH_BLOCK_SIZE = 1024  # Высота полосы (в строках) при поблочном сглаживании (None — растр целиком)
+RASTER_DRIVER = "COG"      # Формат растров: "COG" (тайлы, сжатие, обзорные уровни) или "GTiff" (без сжатия)
+RASTER_COMPRESS = "ZSTD"   # Сжатие растров COG: "ZSTD", "DEFLATE", "LZW" или "NONE"
+HEIGHT_ENCODING = "float32"  # Хранение высот: "float32", "float16" или "int16" (с масштабом HEIGHT_RESOLUTION)
+HEIGHT_RESOLUTION = 0.01   # Шаг высот в метрах при HEIGHT_ENCODING = "int16"
+# Параметры записи растров (см. rast.DEFAULT_RASTER_FORMAT)
+RASTER_FORMAT = {'driver': RASTER_DRIVER, 'compress': RASTER_COMPRESS, 'encoding': HEIGHT_ENCODING,
+                 'resolution': HEIGHT_RESOLUTION}
+USE_CHM = True  # Строить модель высот полога (CHM) по облаку леса, нормализованному по рельефу, вместо растра леса
+CROP_COMPRESS = False  # Сохранять облака точек деревьев в формате LAZ (требуется lazrs или laszip)
+CLUSTER_TILE_SIZE = 50.0  # Размер тайла (в метрах) при кластеризации вершин деревьев
 MIN_DISTANCE_BETWEEN_TREES = 3  # Минимальное расстояние между деревьями (в пикселях)
 k = 0.15  # Коэффициент для расчета диаметра кроны
-CRS = "EPSG:32638"  # Система координат
\ No newline at end of file
+CRS = "EPSG:32638"  # Система координат
+
+# Пакетная обработка нескольких сцен (batch.py)
+BATCH_INPUT_PATH = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Tiles"  # Папка тайлов или CSV-манифест (tile, ground, canopy, необязательно tile_id)
+BATCH_OUTPUT_FOLDER = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Tiles output"
+BATCH_OUTPUT_PATH = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Tiles output\tree_crowns_with_class" + VECTOR_EXTENSION
+BATCH_WORKERS = 2            # Число тайлов, обрабатываемых параллельно (у каждого процесса своя копия модели)
+BATCH_ID_STRIDE = 1_000_000  # Глобальный ID дерева = tile_id * BATCH_ID_STRIDE + ID дерева в тайле (без tile_id — номер тайла + 1, ID уникальны в пределах запуска)
+BATCH_TILE_BUFFER = 20.0     # Буфер тайла (м) из точек соседних тайлов: не меньше радиуса кроны, чтобы кроны у границы не обрезались
+BATCH_MERGE_DISTANCE = 2.0   # Допуск (м) для вершин у границы тайла; вершины соседних тайлов ближе этого расстояния — одно дерево
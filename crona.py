@@ -1,74 +1,77 @@
 import geopandas as gpd
-from shapely.geometry import Point, Polygon
+import shapely
 import numpy as np
 from config import k
+from vector_io import read_vector, write_vector
 
-def create_crown_polygons_with_attributes(input_points_path, output_polygons_path, k=None):
+def create_crown_polygons_with_attributes(input_points_path, output_polygons_path, k=None, points_gdf=None,
+                                          save_output=True):
     """
     Создает полигоны крон деревьев на основе точек вершин деревьев и добавляет атрибуты из точечного слоя.
 
-    :param input_points_path: Путь к входному файлу точек (Shapefile или GeoJSON).
-    :param output_polygons_path: Путь для сохранения выходного файла полигонов.
+    :param input_points_path: Путь к входному слою точек (GeoParquet, FlatGeobuf или Shapefile).
+    :param output_polygons_path: Путь для сохранения слоя полигонов (формат по расширению).
     :param k: Коэффициент для расчета диаметра кроны (диаметр = k * высота). Если None, берется из config.py.
+    :param points_gdf: Слой вершин деревьев в памяти (с этапа 2); если задан, input_points_path не читается.
+    :param save_output: Сохранять слой полигонов в output_polygons_path.
+    :return: GeoDataFrame полигонов крон.
     """
     if k is None:
         k = globals()['k']
 
     # Загрузка точечного слоя
-    points_gdf = gpd.read_file(input_points_path)
+    if points_gdf is None:
+        points_gdf = read_vector(input_points_path)
     
     # Проверка наличия необходимых атрибутов
     required_columns = {'tree_id', 'height', 'x_coord', 'y_coord'}
     if not required_columns.issubset(points_gdf.columns):
         raise ValueError(f"Входной файл должен содержать атрибуты: {required_columns}!")
 
-    # Функция для создания круга
-    def create_circle(center, radius, num_segments=36):
+    # Функция для создания кругов
+    def create_circles(x, y, radius, num_segments=36):
         """
-        Создает круг с заданным центром и радиусом.
+        Создает круги с заданными центрами и радиусами одним вызовом shapely.
 
-        :param center: Центр круга (tuple с координатами X и Y).
-        :param radius: Радиус круга.
+        :param x: Массив координат X центров.
+        :param y: Массив координат Y центров.
+        :param radius: Массив радиусов.
         :param num_segments: Количество сегментов для аппроксимации круга.
-        :return: Полигон, представляющий круг.
+        :return: Массив полигонов, представляющих круги.
         """
         angles = np.linspace(0, 2 * np.pi, num_segments, endpoint=False)
-        circle_coords = [
-            (center.x + radius * np.cos(angle), center.y + radius * np.sin(angle))
-            for angle in angles
-        ]
-        return Polygon(circle_coords)
+        unit_circle = np.column_stack((np.cos(angles), np.sin(angles)))  # (num_segments, 2)
 
-    # Создание полигонов крон
-    polygons = []
-    for _, row in points_gdf.iterrows():
-        tree_id = row['tree_id']  # ID дерева
-        height = row['height']    # Высота дерева
-        x_coord = row['x_coord']  # Координата X
-        y_coord = row['y_coord']  # Координата Y
-        diameter = k * height     # Диаметр кроны
-        radius = diameter / 2     # Радиус кроны
+        # Буфер координат (N, num_segments, 2): центр + радиус * единичная окружность
+        centers = np.column_stack((x, y))[:, None, :]
+        circle_coords = centers + radius[:, None, None] * unit_circle[None, :, :]
+        return shapely.polygons(circle_coords)
 
-        # Создание круга
-        point = Point(x_coord, y_coord)  # Точка вершины дерева
-        circle = create_circle(point, radius)
+    # Создание полигонов крон
+    x_coord = points_gdf['x_coord'].to_numpy(dtype=np.float64)  # Координата X
+    y_coord = points_gdf['y_coord'].to_numpy(dtype=np.float64)  # Координата Y
+    height = points_gdf['height'].to_numpy(dtype=np.float64)    # Высота дерева
+    diameter = k * height     # Диаметр кроны
+    radius = diameter / 2     # Радиус кроны
 
-        # Добавление атрибутов
-        polygons.append({
-            'geometry': circle,
-            'tree_id': tree_id,
+    # Создание GeoDataFrame для полигонов
+    polygons_gdf = gpd.GeoDataFrame(
+        {
+            'tree_id': points_gdf['tree_id'].to_numpy(),
             'x_coord': x_coord,
             'y_coord': y_coord,
             'height': height,
             'diameter': diameter
-        })
-
-    # Создание GeoDataFrame для полигонов
-    polygons_gdf = gpd.GeoDataFrame(polygons, crs=points_gdf.crs)
+        },
+        geometry=create_circles(x_coord, y_coord, radius),
+        crs=points_gdf.crs
+    )
 
     # Сохранение полигонов в файл
-    polygons_gdf.to_file(output_polygons_path, driver="ESRI Shapefile")
-    print(f"Полигоны крон деревьев сохранены: {output_polygons_path}")
+    if save_output:
+        write_vector(polygons_gdf, output_polygons_path)
+        print(f"Полигоны крон деревьев сохранены: {output_polygons_path}")
+    return polygons_gdf
 
 # Пример использования
 if __name__ == "__main__":
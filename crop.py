@@ -1,48 +1,197 @@
 import os
+import copy
+from concurrent.futures import ThreadPoolExecutor
 import laspy
-import geopandas as gpd
-from shapely.geometry import Point
+import shapely
 import numpy as np
+from vector_io import read_vector
 
-def crop_point_cloud_by_polygons(input_shp_path, input_las_path, output_folder):
-    os.makedirs(output_folder, exist_ok=True)
 
+def build_point_grid(x, y, cell_size):
+    """
+    Построение сеточного индекса точек: точки сортируются по номеру ячейки,
+    чтобы точки одной строки сетки лежали в массиве непрерывно.
+
+    :param x: Массив координат X.
+    :param y: Массив координат Y.
+    :param cell_size: Размер ячейки сетки (в метрах).
+    :return: Словарь с параметрами сетки, отсортированными ключами ячеек и порядком точек.
+    """
+    x0, y0 = x.min(), y.min()
+    n_cols = int((x.max() - x0) // cell_size) + 1
+    n_rows = int((y.max() - y0) // cell_size) + 1
+
+    cell_x = ((x - x0) // cell_size).astype(np.int64)
+    cell_y = ((y - y0) // cell_size).astype(np.int64)
+    keys = cell_y * n_cols + cell_x
+
+    order = np.argsort(keys, kind="stable")
+    return {
+        'x0': x0,
+        'y0': y0,
+        'cell_size': cell_size,
+        'n_cols': n_cols,
+        'n_rows': n_rows,
+        'keys': keys[order],
+        'order': order
+    }
+
+
+def query_point_grid(grid, bounds):
+    """
+    Выбор индексов точек, чьи ячейки пересекаются с охватом (minx, miny, maxx, maxy).
+    Возвращает индексы в исходном порядке точек.
+    """
+    min_x, min_y, max_x, max_y = bounds
+    cell_size = grid['cell_size']
+
+    col_from = max(int((min_x - grid['x0']) // cell_size), 0)
+    col_to = min(int((max_x - grid['x0']) // cell_size), grid['n_cols'] - 1)
+    row_from = max(int((min_y - grid['y0']) // cell_size), 0)
+    row_to = min(int((max_y - grid['y0']) // cell_size), grid['n_rows'] - 1)
+    if col_from > col_to or row_from > row_to:
+        return np.empty(0, dtype=np.int64)
+
+    # Ячейки одной строки сетки идут подряд, поэтому каждая строка — один срез
+    rows = np.arange(row_from, row_to + 1)
+    starts = np.searchsorted(grid['keys'], rows * grid['n_cols'] + col_from, side="left")
+    ends = np.searchsorted(grid['keys'], rows * grid['n_cols'] + col_to, side="right")
+
+    candidates = np.concatenate([grid['order'][s:e] for s, e in zip(starts, ends)])
+    return np.sort(candidates)
+
+
+def label_points_by_crowns(crowns_tree, x, y):
+    """
+    Определение крон, в которые попадает каждая точка порции.
+    По пространственному индексу крон (STRtree) выбираются кроны, пересекающие охват порции;
+    для каждой кроны точки-кандидаты берутся из сеточного индекса точек по охвату кроны
+    и проверяются векторно (shapely.contains_xy) без создания геометрий точек.
+    Возвращает пары (индекс точки, индекс кроны), упорядоченные по кроне, а внутри кроны — по точке.
+    Точка, попавшая в несколько перекрывающихся крон, входит в каждую из них.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    empty = np.empty(0, dtype=np.int64)
+    if len(x) == 0:
+        return empty, empty
+    crowns = np.sort(crowns_tree.query(shapely.box(x.min(), y.min(), x.max(), y.max())))
+    if len(crowns) == 0:
+        return empty, empty
+
+    # Размер ячейки сетки равен наибольшей кроне: крона проверяется только по точкам соседних ячеек
+    geometries = crowns_tree.geometries.take(crowns)
+    crown_bounds = shapely.bounds(geometries)
+    crown_sizes = np.nan_to_num(np.maximum(crown_bounds[:, 2] - crown_bounds[:, 0],
+                                           crown_bounds[:, 3] - crown_bounds[:, 1]))
+    grid = build_point_grid(x, y, max(crown_sizes.max(initial=0.0), 1.0))
+
+    point_parts, crown_parts = [], []
+    for crown, geometry, bounds in zip(crowns, geometries, crown_bounds):
+        candidates = query_point_grid(grid, bounds)
+        if len(candidates) == 0:
+            continue
+        inside = candidates[shapely.contains_xy(geometry, x[candidates], y[candidates])]
+        point_parts.append(inside)
+        crown_parts.append(np.full(len(inside), crown, dtype=np.int64))
+    if not point_parts:
+        return empty, empty
+    return np.concatenate(point_parts), np.concatenate(crown_parts)
+
+
+def write_tree_las(tree_id, tree_records, header, output_folder, compress=False):
+    """
+    Сохранение облака точек одного дерева в файл {tree_id}.las ({tree_id}.laz при compress=True).
+    Записываются полные записи точек исходного файла (интенсивность, номера отражений,
+    классы и т.д.) с исходным заголовком, масштабами и смещениями — без переквантования.
+    """
+    records = laspy.ScaleAwarePointRecord(tree_records, header.point_format, header.scales, header.offsets)
+    new_las = laspy.LasData(header=copy.deepcopy(header), points=records)
+
+    # Сохранение LAS-файла (количество точек и границы в заголовке обновляются при записи)
+    extension = "laz" if compress else "las"
+    output_las_path = os.path.join(output_folder, f"{tree_id}.{extension}")
+    new_las.write(output_las_path, do_compress=compress)
+    return output_las_path, np.column_stack((records.x, records.y, records.z))
+
+
+def remove_tree_files(output_folder):
+    """
+    Удаление облаков деревьев прошлых запусков ({tree_id}.las / {tree_id}.laz) из папки,
+    чтобы в ней остались только деревья текущего слоя крон (папку читают load_tree_profiles и конвейер).
+    """
+    if not os.path.isdir(output_folder):
+        return
+    for file_name in os.listdir(output_folder):
+        stem, extension = os.path.splitext(file_name)
+        if stem.isdigit() and extension.lower() in (".las", ".laz"):
+            os.remove(os.path.join(output_folder, file_name))
+
+
+def crop_point_cloud_by_polygons(input_shp_path, input_las_path, output_folder, chunk_size=None, workers=None,
+                                 compress=False, polygons_gdf=None, save_files=True):
+    """
+    Вырезание облаков точек отдельных деревьев по полигонам крон за один проход по LAS-файлу.
+    Файл читается порциями по chunk_size точек, каждой точке назначаются кроны по
+    пространственному индексу (STRtree), точки группируются по кронам сортировкой.
+    Файлы деревьев содержат срезы исходных записей точек с исходным заголовком
+    (при compress=True — в формате LAZ) и записываются в пуле из workers потоков, файлы деревьев
+    прошлых запусков перед записью удаляются; при save_files=False файлы не записываются. polygons_gdf — слой крон в памяти (с этапа 3),
+    если он задан, input_shp_path не читается.
+
+    :return: Словарь {tree_id: массив точек (N, 3)} для расчета атрибутов без повторного чтения с диска.
+    """
     # Загрузка SHP-файла крон деревьев
-    polygons_gdf = gpd.read_file(input_shp_path)
+    if polygons_gdf is None:
+        polygons_gdf = read_vector(input_shp_path, columns=["tree_id"])
     if 'tree_id' not in polygons_gdf.columns:
         raise ValueError("Входной SHP-файл должен содержать атрибут 'tree_id'!")
 
-    # Чтение LAS-файла
-    las = laspy.read(input_las_path)  # Прямое чтение без использования with
-    points = np.vstack((las.x, las.y, las.z)).T  # Массив точек (x, y, z)
-
-    # Функция для проверки, находится ли точка внутри полигона
-    def is_point_in_polygon(point, polygon):
-        return polygon.contains(Point(point[0], point[1]))
+    tree_ids = polygons_gdf['tree_id'].to_numpy()
+    crowns_tree = shapely.STRtree(polygons_gdf.geometry.values)
 
-    # Обработка каждого полигона
-    for _, row in polygons_gdf.iterrows():
-        tree_id = row['tree_id']
-        polygon = row['geometry']
+    # Один проход по LAS-файлу: записи точек каждой порции раскладываются по кронам
+    tree_chunks = {}
+    with laspy.open(input_las_path) as las_file:
+        header = las_file.header
+        for chunk in las_file.chunk_iterator(chunk_size or max(header.point_count, 1)):
+            point_idx, crown_idx = label_points_by_crowns(crowns_tree, chunk.x, chunk.y)
+            if len(crown_idx) == 0:
+                continue
+            starts = np.flatnonzero(np.r_[True, crown_idx[1:] != crown_idx[:-1]])
+            ends = np.r_[starts[1:], len(crown_idx)]
+            for start, end in zip(starts, ends):
+                tree_chunks.setdefault(crown_idx[start], []).append(chunk.array[point_idx[start:end]])
 
-        # Фильтрация точек внутри полигона
-        filtered_points = [point for point in points if is_point_in_polygon(point, polygon)]
-
-        if len(filtered_points) == 0:
+    # Сборка записей точек деревьев в порядке слоя крон
+    tree_records = {}
+    for crown, tree_id in enumerate(tree_ids):
+        if crown not in tree_chunks:
             print(f"Предупреждение: Нет точек для дерева с ID {tree_id}. Пропускаем.")
             continue
+        tree_records[tree_id] = np.concatenate(tree_chunks.pop(crown))
+
+    # Без записи файлов: только координаты точек деревьев
+    if not save_files:
+        tree_points = {}
+        for tree_id, records in tree_records.items():
+            records = laspy.ScaleAwarePointRecord(records, header.point_format, header.scales, header.offsets)
+            tree_points[tree_id] = np.column_stack((records.x, records.y, records.z))
+        return tree_points
 
-        # Преобразование отфильтрованных точек в формат LAS
-        filtered_points = np.array(filtered_points)
-        new_las = laspy.create()
-        new_las.x = filtered_points[:, 0]
-        new_las.y = filtered_points[:, 1]
-        new_las.z = filtered_points[:, 2]
+    # Параллельная запись файлов деревьев
+    os.makedirs(output_folder, exist_ok=True)
+    remove_tree_files(output_folder)
+    tree_points = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            tree_id: executor.submit(write_tree_las, tree_id, records, header, output_folder, compress)
+            for tree_id, records in tree_records.items()
+        }
+        for tree_id, future in futures.items():
+            output_las_path, tree_points[tree_id] = future.result()
+            print(f"Сохранено облако точек для дерева с ID {tree_id}: {output_las_path}")
 
-        # Сохранение LAS-файла
-        output_las_path = os.path.join(output_folder, f"{tree_id}.las")
-        new_las.write(output_las_path)  # Используем write вместо with
-        print(f"Сохранено облако точек для дерева с ID {tree_id}: {output_las_path}")
+    return tree_points
 
 # Пример использования
 if __name__ == "__main__":
@@ -50,4 +199,4 @@ if __name__ == "__main__":
     input_las_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Point Cloud\Cloud.las"
     output_folder = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Point Cloud Crop"
 
-    crop_point_cloud_by_polygons(input_shp_path, input_las_path, output_folder)
\ No newline at end of file
+    crop_point_cloud_by_polygons(input_shp_path, input_las_path, output_folder)
@@ -1,22 +1,14 @@
-from stage_1_raster_creation import stage_1
-from stage_2_tree_detection import stage_2
-from stage_3_crown_polygons import stage_3
-from stage_4_crop_trees import stage_4
-from stage_5_add_attributes import stage_5
-from stage_6_classification import stage_6
+from pipeline import run_pipeline
 
-def main():
+def main(force=False):
     print("Начало обработки проекта таксации леса...")
 
-    # Выполнение этапов
-    stage_1()
-    stage_2()
-    stage_3()
-    stage_4()
-    stage_5()
-    stage_6()
+    # Выполнение этапов: этапы, входные данные и параметры которых не изменились
+    # с прошлого запуска (см. манифест), пропускаются; force=True выполняет все этапы заново.
+    # Облака точек деревьев (этап 4) и профили (этап 5) передаются следующим этапам в памяти.
+    run_pipeline(force=force)
 
     print("\nОбработка завершена!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
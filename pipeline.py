@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import hashlib
+from datetime import datetime
+
+import config
+from stage_1_raster_creation import stage_1
+from stage_2_tree_detection import stage_2
+from stage_3_crown_polygons import stage_3
+from stage_4_crop_trees import stage_4
+from stage_5_add_attributes import stage_5
+from stage_6_classification import stage_6
+
+# Файлы, из которых состоит один слой Shapefile
+SHAPEFILE_EXTENSIONS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+# Допуск при сравнении времени изменения выходных файлов со временем запуска этапа (с)
+MTIME_TOLERANCE = 2.0
+
+
+def code_files(*module_names):
+    """
+    Пути к исходным файлам модулей проекта: изменение кода этапа тоже приводит к его перезапуску.
+    """
+    project_folder = os.path.dirname(os.path.abspath(__file__))
+    return [os.path.join(project_folder, f"{module_name}.py") for module_name in module_names]
+
+
+def run_classification(results):
+    """
+    Запуск этапа 6 с профилями и слоем крон этапа 5 (если он выполнялся в этом запуске).
+    """
+    crowns_gdf, profiles = results.get("stage_5", (None, None))
+    return stage_6(profiles, crowns_gdf)
+
+
+def pipeline_stages():
+    """
+    Описание этапов обработки: входные файлы, параметры, влияющие на результат, и выходные файлы.
+    Параметры производительности (размеры порций, число процессов) в описание не входят; размер тайла
+    и буфер входят, так как от разбиения на тайлы зависит заполнение пустых пикселей и сглаживание.
+    run — функция запуска этапа, получающая результаты предыдущих этапов в памяти
+    (растры, слои GeoDataFrame, облака точек деревьев). Если предыдущий этап пропущен,
+    следующий читает его результат с диска.
+    """
+    las_files = sorted(
+        os.path.join(config.LAS_FOLDER, f) for f in os.listdir(config.LAS_FOLDER) if f.endswith(".las")
+    ) if os.path.isdir(config.LAS_FOLDER) else []
+    profile_source = config.IMAGE_FOLDER if config.CLASSIFY_FROM_PNG else config.input_cropped_folder
+    # Этап 2 читает готовую модель высот полога или пару растров рельефа и леса
+    height_rasters = [config.chm_raster_path] if config.USE_CHM else [config.relief_raster_path, config.trees_raster_path]
+
+    return [
+        {
+            'name': "stage_1",
+            'run': lambda results: stage_1(),
+            'inputs': las_files + code_files("rast", "raster_grid", "stage_1_raster_creation"),
+            'params': {
+                'pixel_size': config.PIXEL_SIZE,
+                'sigma': config.SIGMA,
+                'canopy_reduction': config.CANOPY_REDUCTION,
+                'ground_reduction': config.GROUND_REDUCTION,
+                'ground_percentile': config.GROUND_PERCENTILE,
+                'tile_size': config.TILE_SIZE,
+                'tile_buffer': config.TILE_BUFFER,
+                'raster_driver': config.RASTER_DRIVER,
+                'raster_compress': config.RASTER_COMPRESS,
+                'height_encoding': config.HEIGHT_ENCODING,
+                'height_resolution': config.HEIGHT_RESOLUTION,
+                'use_chm': config.USE_CHM
+            },
+            'outputs': [config.relief_raster_path] + height_rasters[-1:]
+        },
+        {
+            'name': "stage_2",
+            'run': lambda results: stage_2(results.get("stage_1")),
+            'inputs': height_rasters
+                      + code_files("tree_detection", "clustering", "stage_2_tree_detection"),
+            'params': {'use_chm': config.USE_CHM},
+            'outputs': [config.output_path]
+        },
+        {
+            'name': "stage_3",
+            'run': lambda results: stage_3(results.get("stage_2")),
+            'inputs': [config.input_points_path] + code_files("crona", "stage_3_crown_polygons"),
+            'params': {'k': config.k, 'crs': config.CRS},
+            'outputs': [config.output_polygons_path]
+        },
+        {
+            'name': "stage_4",
+            'run': lambda results: stage_4(results.get("stage_3")),
+            'inputs': [config.input_shp_path, os.path.join(config.LAS_FOLDER, "Cloud.las")]
+                      + code_files("crop", "stage_4_crop_trees"),
+            'params': {'crop_compress': config.CROP_COMPRESS},
+            'outputs': [config.POINT_CLOUD_CROP_FOLDER]
+        },
+        {
+            'name': "stage_5",
+            'run': lambda results: stage_5(results.get("stage_4"), results.get("stage_3")),
+            'inputs': [config.output_crowns_shp, config.input_cropped_folder]
+                      + code_files("tree_profile", "stage_5_add_attributes"),
+            'params': {
+                'save_profile_png': config.SAVE_PROFILE_PNG,
+                'classify_from_png': config.CLASSIFY_FROM_PNG,
+                'profile_image_size': config.PROFILE_IMAGE_SIZE
+            },
+            # Графики PNG — тоже результат этапа: этап 6 читает их при CLASSIFY_FROM_PNG
+            'outputs': [config.output_cropped_folder]
+                       + ([config.IMAGE_FOLDER] if config.SAVE_PROFILE_PNG or config.CLASSIFY_FROM_PNG else [])
+        },
+        {
+            'name': "stage_6",
+            'run': run_classification,
+            'inputs': [config.SHP_PATH, config.MODEL_PATH, profile_source]
+                      + ([config.CALIBRATION_FOLDER] if config.QUANTIZATION == "static" else [])
+                      + code_files("Efficintnet", "tree_profile", "stage_6_classification"),
+            'params': {
+                'save_profile_png': config.SAVE_PROFILE_PNG,
+                'classify_from_png': config.CLASSIFY_FROM_PNG,
+                'profile_image_size': config.PROFILE_IMAGE_SIZE,
+                'model_name': config.MODEL_NAME,
+                'input_size': config.INPUT_SIZE,
+                'quantization': config.QUANTIZATION,
+                'calibration_size': config.CALIBRATION_SIZE
+            },
+            'outputs': [config.OUTPUT_SHP_PATH] + ([config.EXPORT_SHP_PATH] if config.EXPORT_SHP_PATH else [])
+        },
+    ]
+
+
+def load_manifest(manifest_path):
+    """
+    Загрузка манифеста конвейера (пустой манифест, если файла нет или он поврежден).
+    """
+    manifest = {'file_hashes': {}, 'stages': {}}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest.update(json.load(f))
+        except Exception as e:
+            print(f"Ошибка при чтении манифеста {manifest_path}: {e}. Все этапы будут выполнены заново.")
+    return manifest
+
+
+def save_manifest(manifest, manifest_path):
+    """
+    Сохранение манифеста через временный файл, чтобы прерванная запись не повредила его.
+    """
+    folder = os.path.dirname(manifest_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, manifest_path)
+
+
+def file_hash(path, file_hashes):
+    """
+    SHA-256 содержимого файла. Хэш кэшируется в манифесте по размеру и времени изменения файла,
+    поэтому неизмененные большие LAS-файлы не перечитываются при каждом запуске.
+    """
+    stat = os.stat(path)
+    cached = file_hashes.get(path)
+    if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+        return cached['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            digest.update(block)
+    file_hashes[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+    return digest.hexdigest()
+
+
+def path_files(path):
+    """
+    Файлы, составляющие путь: все файлы папки, все файлы слоя Shapefile или сам файл.
+    """
+    if os.path.isdir(path):
+        return sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    base, extension = os.path.splitext(path)
+    if extension.lower() in SHAPEFILE_EXTENSIONS:
+        return [base + ext for ext in SHAPEFILE_EXTENSIONS if os.path.exists(base + ext)]
+    return [path] if os.path.exists(path) else []
+
+
+def path_hash(path, file_hashes):
+    """
+    Хэш файла, слоя Shapefile или папки (None, если путь не существует).
+    """
+    files = path_files(path)
+    if not files:
+        return None
+    if files == [path]:
+        return file_hash(path, file_hashes)
+    digest = hashlib.sha256()
+    for file_path in files:
+        digest.update(f"{os.path.relpath(file_path, os.path.dirname(path))}:{file_hash(file_path, file_hashes)}\n".encode())
+    return digest.hexdigest()
+
+
+def outputs_updated(outputs, start_time):
+    """
+    Проверка, что этап записал все выходные файлы (этапы сообщают об ошибках выводом, а не исключением).
+    """
+    for path in outputs:
+        files = path_files(path)
+        if not files or max(os.path.getmtime(f) for f in files) < start_time - MTIME_TOLERANCE:
+            return False
+    return True
+
+
+def rerun_reason(stage, record, inputs, params, file_hashes):
+    """
+    Причина повторного выполнения этапа (None, если этап можно пропустить).
+    """
+    if record is None:
+        return "нет записи в манифесте"
+    changed_inputs = [path for path, digest in inputs.items() if record['inputs'].get(path) != digest]
+    changed_inputs += [path for path in record['inputs'] if path not in inputs]
+    if changed_inputs:
+        return f"изменились входные данные: {', '.join(os.path.basename(p) or p for p in changed_inputs)}"
+    changed_params = sorted(set(params) ^ set(record['params'])
+                            | {key for key in params if record['params'].get(key) != params[key]})
+    if changed_params:
+        return f"изменились параметры: {', '.join(changed_params)}"
+    for path in stage['outputs']:
+        if path_hash(path, file_hashes) != record['outputs'].get(path):
+            return f"выходные данные отсутствуют или изменены: {os.path.basename(path) or path}"
+    return None
+
+
+def run_pipeline(manifest_path=None, force=False):
+    """
+    Инкрементальный запуск этапов обработки.
+    Для каждого этапа в манифесте хранятся хэши входных файлов (включая код этапа), параметры
+    и хэши выходных файлов. Этап пропускается, если ничего из этого не изменилось; после
+    перезапуска этапа его новые выходные данные меняют входы следующих этапов, и они тоже перезапускаются.
+
+    :param manifest_path: Путь к JSON-манифесту (по умолчанию config.PIPELINE_MANIFEST_PATH).
+    :param force: Выполнить все этапы заново.
+    :return: Результаты выполненных этапов в памяти ({имя этапа: результат}).
+    """
+    # Без контрольных точек (SAVE_CHECKPOINTS = False) промежуточные результаты не записываются
+    # на диск, поэтому этапы не пропускаются: все выполняются подряд с передачей результатов в памяти
+    if not config.SAVE_CHECKPOINTS:
+        results = {}
+        for stage in pipeline_stages():
+            print(f"\n{stage['name']}: выполнение (без контрольных точек).")
+            results[stage['name']] = stage['run'](results)
+        return results
+
+    manifest_path = manifest_path or config.PIPELINE_MANIFEST_PATH
+    manifest = load_manifest(manifest_path)
+    file_hashes = manifest['file_hashes']
+
+    results = {}
+    for stage in pipeline_stages():
+        name = stage['name']
+        inputs = {path: path_hash(path, file_hashes) for path in stage['inputs']}
+        params = json.loads(json.dumps(stage['params']))
+        reason = "принудительный запуск" if force else rerun_reason(stage, manifest['stages'].get(name),
+                                                                     inputs, params, file_hashes)
+        if reason is None:
+            print(f"\n{name}: входные данные и параметры не изменились, этап пропущен.")
+            continue
+
+        print(f"\n{name}: выполнение ({reason}).")
+        start_time = time.time()
+        results[name] = stage['run'](results)
+
+        if not outputs_updated(stage['outputs'], start_time):
+            print(f"Ошибка: {name} не создал выходные данные {stage['outputs']}. Обработка остановлена.")
+            manifest['stages'].pop(name, None)
+            save_manifest(manifest, manifest_path)
+            return results
+
+        manifest['stages'][name] = {
+            'inputs': inputs,
+            'params': params,
+            'outputs': {path: path_hash(path, file_hashes) for path in stage['outputs']},
+            'finished': datetime.now().isoformat(timespec="seconds")
+        }
+        save_manifest(manifest, manifest_path)
+
+    # Удаление из кэша хэшей файлов, которых больше нет (например, облаков удаленных деревьев)
+    manifest['file_hashes'] = {path: cached for path, cached in file_hashes.items() if os.path.exists(path)}
+    save_manifest(manifest, manifest_path)
+    return results
+
+# Пример использования
+if __name__ == "__main__":
+    run_pipeline()
@@ -1,10 +1,13 @@
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-from scipy.ndimage import gaussian_filter
-from scipy.interpolate import griddata
 from osgeo import gdal, osr
 import laspy
 import matplotlib.pyplot as plt
+from raster_grid import (points_to_pixels, init_pixel_grid, accumulate_points, finalize_pixel_grid, reduce_pixels,
+                         bin_points_to_grid, fill_empty_pixels, smooth_block, smooth_raster, plan_tiles,
+                         split_points_to_tiles, interpolate_ground, buffer_window, grid_tile)
 
 def read_las_file(file_path):
     """
@@ -19,104 +22,547 @@ def read_las_file(file_path):
         return None
 
 
-def create_raster_from_points(points, output_path, pixel_size=0.1, nodata_value=-9999):
+def read_las_bounds(file_path):
     """
-    Создание растра из облака точек.
+    Чтение границ облака точек (min_x, max_x, min_y, max_y) из заголовка .las файла
+    без загрузки самих точек.
+    """
+    with laspy.open(file_path) as las_file:
+        mins, maxs = las_file.header.mins, las_file.header.maxs
+    return mins[0], maxs[0], mins[1], maxs[1]
+
+
+def iter_las_chunks(file_path, chunk_size=5_000_000):
+    """
+    Потоковое чтение .las файла порциями по chunk_size точек.
+    Каждая порция возвращается массивом (N, 3) с координатами x, y, z.
+    """
+    with laspy.open(file_path) as las_file:
+        for chunk in las_file.chunk_iterator(chunk_size):
+            yield np.column_stack((chunk.x, chunk.y, chunk.z))
+
+
+def create_raster_from_las(file_path, output_path, pixel_size=0.1, chunk_size=5_000_000, nodata_value=-9999,
+                           reduction="max", fill_gaps=True, raster_format=None):
+    """
+    Потоковое создание растра из .las файла.
+    Точки читаются порциями и накапливаются по пикселям (reduction: "max", "min" или "mean"),
+    поэтому в памяти одновременно находятся только растр и одна порция точек.
+    Если output_path равен None, растр только возвращается, без записи в файл.
+    raster_format — параметры записи растра (см. DEFAULT_RASTER_FORMAT).
+    """
+    try:
+        bounds = read_las_bounds(file_path)
+        min_x, max_x, min_y, max_y = bounds
+
+        # Вычисление размеров растра
+        x_res = int((max_x - min_x) / pixel_size)
+        y_res = int((max_y - min_y) / pixel_size)
+
+        pixel_grid = init_pixel_grid((y_res, x_res), reduction)
+        for points in iter_las_chunks(file_path, chunk_size):
+            rows, cols = points_to_pixels(points, bounds, pixel_size, (y_res, x_res))
+            accumulate_points(pixel_grid, rows, cols, points[:, 2], reduction)
+        grid_z = finalize_pixel_grid(pixel_grid, reduction)
+
+        # Интерполяция только для пикселей без точек
+        if fill_gaps:
+            grid_z = fill_empty_pixels(grid_z)
+        grid_z[np.isnan(grid_z)] = nodata_value
+
+        geo_transform = (min_x, pixel_size, 0, max_y, 0, -pixel_size)
+        if output_path is not None:
+            write_geotiff(grid_z, geo_transform, output_path, nodata_value=nodata_value, raster_format=raster_format)
+            print(f"Растр успешно создан: {output_path}")
+        return grid_z, bounds, pixel_size
+
+    except Exception as e:
+        print(f"Ошибка при создании растра: {e}")
+        return None
+
+
+def create_raster_from_points(points, output_path, pixel_size=0.1, nodata_value=-9999,
+                              reduction="max", percentile=50, fill_gaps=True, raster_format=None):
+    """
+    Создание растра из облака точек биннингом точек по пикселям.
+    reduction: "max" (поверхность крон), "min" или "percentile" (рельеф), "mean".
+    Пиксели без точек заполняются интерполяцией, если fill_gaps=True.
+    Если output_path равен None, растр только возвращается, без записи в файл.
+    raster_format — параметры записи растра (см. DEFAULT_RASTER_FORMAT).
     """
     try:
         # Определение границ облака точек
         min_x, min_y = points[:, 0].min(), points[:, 1].min()
         max_x, max_y = points[:, 0].max(), points[:, 1].max()
+        bounds = (min_x, max_x, min_y, max_y)
 
         # Вычисление размеров растра
         x_res = int((max_x - min_x) / pixel_size)
         y_res = int((max_y - min_y) / pixel_size)
 
-        # Создание сетки для интерполяции
-        grid_x, grid_y = np.meshgrid(
-            np.linspace(min_x, max_x, x_res),
-            np.linspace(min_y, max_y, y_res)
-        )
+        # Агрегация высот по пикселям
+        grid_z = bin_points_to_grid(points, bounds, pixel_size, (y_res, x_res),
+                                    reduction=reduction, percentile=percentile)
 
-        # Интерполяция значений атрибута
-        grid_z = griddata(
-            points[:, :2],  # Координаты X, Y
-            points[:, 2],   # Значения высоты
-            (grid_x, grid_y),
-            method='linear',  # Метод интерполяции
-            fill_value=nodata_value
-        )
-
-        # Инверсия массива данных по оси Y
-        grid_z = np.flipud(grid_z)
+        # Интерполяция только для пикселей без точек
+        if fill_gaps:
+            grid_z = fill_empty_pixels(grid_z)
+        grid_z[np.isnan(grid_z)] = nodata_value
 
         # Сохранение растра в файл GeoTIFF
-        driver = gdal.GetDriverByName("GTiff")
-        out_raster = driver.Create(output_path, x_res, y_res, 1, gdal.GDT_Float32)
-        out_raster.SetGeoTransform((min_x, pixel_size, 0, max_y, 0, -pixel_size))
+        if output_path is not None:
+            write_geotiff(grid_z, (min_x, pixel_size, 0, max_y, 0, -pixel_size), output_path, nodata_value=nodata_value,
+                          raster_format=raster_format)
+            print(f"Растр успешно создан: {output_path}")
+        return grid_z, bounds, pixel_size
 
-        # Установка системы координат (EPSG:32638)
-        srs = osr.SpatialReference()
-        srs.ImportFromEPSG(32638)  # UTM зона 38N
-        out_raster.SetProjection(srs.ExportToWkt())
+    except Exception as e:
+        print(f"Ошибка при создании растра: {e}")
+        return None
 
-        # Запись данных в растр
-        out_band = out_raster.GetRasterBand(1)
-        out_band.WriteArray(grid_z)
-        out_band.SetNoDataValue(nodata_value)
-        out_band.FlushCache()
 
-        print(f"Растр успешно создан: {output_path}")
-        return grid_z, (min_x, max_x, min_y, max_y), pixel_size
+def smooth_raster_file(input_path, output_path, sigma=1.5, block_size=1024, nodata_value=-9999, raster_format=None):
+    """
+    Сглаживание растра из файла GeoTIFF полосами по block_size строк.
+    В памяти одновременно находится только одна полоса с перекрытием,
+    поэтому обрабатываются растры любого размера. Высоты входного растра
+    декодируются с учетом масштаба и смещения канала (кодирование float16/int16).
+    """
+    try:
+        src = gdal.Open(input_path)
+        src_band = src.GetRasterBand(1)
+        cols, rows = src.RasterXSize, src.RasterYSize
+
+        out_raster, written_path = create_output_raster(output_path, rows, cols, src.GetGeoTransform(),
+                                                        nodata_value=nodata_value, raster_format=raster_format)
+        out_band = out_raster.GetRasterBand(1)
 
+        halo = int(4.0 * sigma + 0.5)  # Радиус гауссовского ядра (truncate=4.0)
+        for row_off in range(0, rows, block_size):
+            row_from = max(row_off - halo, 0)
+            row_to = min(row_off + block_size + halo, rows)
+            block = decode_heights(src_band, src_band.ReadAsArray(0, row_from, cols, row_to - row_from), nodata_value)
+            block = smooth_block(block, sigma=sigma, nodata_value=nodata_value)
+            out_band.WriteArray(block[row_off - row_from:row_off - row_from + block_size], 0, row_off)
+
+        finish_output_raster(out_raster, written_path, output_path, nodata_value=nodata_value,
+                             raster_format=raster_format)
+        out_raster = None
+        src = None
+        print(f"Сглаженный растр успешно сохранен: {output_path}")
     except Exception as e:
-        print(f"Ошибка при создании растра: {e}")
-        return None
+        print(f"Ошибка при сглаживании растра: {e}")
+
 
+# Параметры записи растров по умолчанию:
+# driver — "COG" (Cloud Optimized GeoTIFF: внутренние тайлы, сжатие, обзорные уровни) или "GTiff" (прежний формат),
+# compress — сжатие ("ZSTD", "DEFLATE", "LZW", "NONE"),
+# encoding — хранение высот: "float32", "float16" (16 бит с плавающей точкой) или "int16" (целые с масштабом),
+# resolution — шаг квантования высот при encoding = "int16" (м).
+DEFAULT_RASTER_FORMAT = {'driver': "COG", 'compress': "ZSTD", 'encoding': "float32", 'resolution': 0.01}
 
-def smooth_raster(input_data, sigma=1.5, nodata_value=-9999):
+# Значение NoData в растрах с кодированием int16
+INT16_NODATA = -32768
+
+
+def resolve_raster_format(raster_format=None):
     """
-    Сглаживание растра с использованием гауссовского фильтра.
-    Исключает значения NoData из процесса сглаживания.
+    Параметры записи растров: значения по умолчанию, дополненные переданными.
     """
-    # Заменяем NoData значения на np.nan
-    valid_mask = input_data != nodata_value
-    valid_data = np.where(valid_mask, input_data, np.nan)
+    resolved = dict(DEFAULT_RASTER_FORMAT)
+    if raster_format:
+        resolved.update(raster_format)
+    if resolved['encoding'] not in ("float32", "float16", "int16"):
+        raise ValueError(f"Неизвестное кодирование высот: {resolved['encoding']}")
+    return resolved
 
-    # Применяем гауссовский фильтр
-    smoothed_valid = gaussian_filter(valid_data, sigma=sigma, mode='reflect')
 
-    # Восстанавливаем NoData значения
-    smoothed_data = np.where(valid_mask, smoothed_valid, nodata_value)
-    return smoothed_data
+def cog_options(raster_format):
+    """
+    Параметры создания COG: тайлы 512x512, сжатие с предиктором, обзорные уровни усреднением.
+    """
+    options = [
+        f"COMPRESS={raster_format['compress']}",
+        "BLOCKSIZE=512",
+        "OVERVIEWS=AUTO",
+        "RESAMPLING=AVERAGE",
+        "BIGTIFF=IF_SAFER",
+        "NUM_THREADS=ALL_CPUS"
+    ]
+    if raster_format['compress'] != "NONE":
+        # Предиктор 3 (FLOATING_POINT) для вещественных высот, 2 (STANDARD) для целых
+        options.append("PREDICTOR=STANDARD" if raster_format['encoding'] == "int16" else "PREDICTOR=FLOATING_POINT")
+    if raster_format['encoding'] == "float16":
+        options.append("NBITS=16")
+    return options
+
+
+def height_encoding(min_value, max_value, raster_format, nodata_value=-9999):
+    """
+    Кодирование высот в файле: (тип данных GDAL, масштаб, смещение, NoData в файле).
+    Высота = значение в файле * масштаб + смещение. Смещение вычитается и в float16,
+    чтобы абсолютные отметки (сотни метров) не теряли точность 16-битного формата.
+    """
+    encoding = raster_format['encoding']
+    if encoding == "float32" or min_value is None:
+        return gdal.GDT_Float32, 1.0, 0.0, nodata_value
+    if encoding == "float16":
+        return gdal.GDT_Float32, 1.0, float(np.floor(min_value)), float(np.float16(nodata_value))
+    scale = max(raster_format['resolution'], (max_value - min_value) / 65534)
+    return gdal.GDT_Int16, scale, (min_value + max_value) / 2, INT16_NODATA
 
 
-def save_smoothed_raster(data, geo_transform, output_path, nodata_value=-9999):
+def encode_heights(data, encoding, nodata_value=-9999):
     """
-    Сохранение сглаженного растра в файл GeoTIFF.
+    Перевод высот в значения файла по кодированию из height_encoding.
     """
-    try:
-        rows, cols = data.shape
-        driver = gdal.GetDriverByName("GTiff")
-        out_raster = driver.Create(output_path, cols, rows, 1, gdal.GDT_Float32)
-        out_raster.SetGeoTransform(geo_transform)
+    data_type, scale, offset, file_nodata = encoding
+    valid = np.isfinite(data) & (data != nodata_value)
+    if scale == 1.0 and offset == 0.0 and file_nodata == nodata_value:
+        return np.where(valid, data, nodata_value).astype(np.float32, copy=False)
+    values = (data.astype(np.float64) - offset) / scale
+    if data_type == gdal.GDT_Int16:
+        values = np.clip(np.round(values), -32767, 32767)
+    values[~valid] = file_nodata
+    return values.astype(np.int16 if data_type == gdal.GDT_Int16 else np.float32)
+
+
+def decode_heights(band, data, nodata_value=-9999):
+    """
+    Высоты из значений канала GDAL с учетом масштаба и смещения; NoData заменяются на nodata_value.
+    """
+    data = data.astype(np.float32)
+    file_nodata = band.GetNoDataValue()
+    scale, offset = band.GetScale() or 1.0, band.GetOffset() or 0.0
+    invalid = data == file_nodata if file_nodata is not None else np.zeros(data.shape, dtype=bool)
+    if scale != 1.0 or offset != 0.0:
+        data = data * np.float32(scale) + np.float32(offset)
+    data[invalid] = nodata_value
+    return data
+
+
+def valid_range(data, nodata_value=-9999):
+    """
+    Минимум и максимум высот без NoData (None, None, если высот нет).
+    """
+    valid = data[np.isfinite(data) & (data != nodata_value)]
+    if valid.size == 0:
+        return None, None
+    return float(valid.min()), float(valid.max())
 
-        # Установка системы координат (EPSG:32638)
-        srs = osr.SpatialReference()
-        srs.ImportFromEPSG(32638)  # UTM зона 38N
-        out_raster.SetProjection(srs.ExportToWkt())
+
+def create_geotiff(output_path, rows, cols, geo_transform, nodata_value=-9999, data_type=gdal.GDT_Float32,
+                   driver_name="GTiff", options=None):
+    """
+    Создание пустого одноканального растра (по умолчанию GeoTIFF Float32, EPSG:32638)
+    для последующей записи данных целиком или окнами.
+    """
+    driver = gdal.GetDriverByName(driver_name)
+    out_raster = driver.Create(output_path, cols, rows, 1, data_type, options=options or [])
+    out_raster.SetGeoTransform(geo_transform)
+
+    # Установка системы координат (EPSG:32638)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32638)  # UTM зона 38N
+    out_raster.SetProjection(srs.ExportToWkt())
+
+    out_raster.GetRasterBand(1).SetNoDataValue(nodata_value)
+    return out_raster
+
+
+def create_output_raster(output_path, rows, cols, geo_transform, nodata_value=-9999, raster_format=None):
+    """
+    Создание растра для записи окнами. Для COG (его нельзя записывать окнами) создается
+    временный тайловый GeoTIFF рядом с выходным файлом; finish_output_raster переводит его в COG.
+    :return: (набор данных GDAL, путь, в который ведется запись).
+    """
+    raster_format = resolve_raster_format(raster_format)
+    if raster_format['driver'] != "COG":
+        return create_geotiff(output_path, rows, cols, geo_transform, nodata_value=nodata_value), output_path
+    temp_path = output_path + ".tmp.tif"
+    out_raster = create_geotiff(temp_path, rows, cols, geo_transform, nodata_value=nodata_value,
+                                options=["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512", "BIGTIFF=IF_SAFER"])
+    return out_raster, temp_path
+
+
+def finish_output_raster(out_raster, written_path, output_path, nodata_value=-9999, raster_format=None,
+                         block_size=2048):
+    """
+    Завершение записи растра, созданного create_output_raster: для COG временный GeoTIFF
+    кодируется (float16/int16) полосами по block_size строк и копируется в COG с обзорными уровнями.
+    """
+    out_raster.FlushCache()
+    raster_format = resolve_raster_format(raster_format)
+    if written_path == output_path:
+        return
+
+    temp_paths = [written_path]
+    try:
+        source = out_raster
+        band = out_raster.GetRasterBand(1)
+        rows, cols = out_raster.RasterYSize, out_raster.RasterXSize
+        if raster_format['encoding'] != "float32":
+            # Диапазон высот для кодирования — по полосам, без чтения растра целиком
+            min_value, max_value = None, None
+            for row_off in range(0, rows, block_size):
+                block_min, block_max = valid_range(band.ReadAsArray(0, row_off, cols, min(block_size, rows - row_off)),
+                                                   nodata_value)
+                if block_min is not None:
+                    min_value = block_min if min_value is None else min(min_value, block_min)
+                    max_value = block_max if max_value is None else max(max_value, block_max)
+            encoding = height_encoding(min_value, max_value, raster_format, nodata_value)
+
+            encoded_path = output_path + ".enc.tif"
+            temp_paths.append(encoded_path)
+            source = create_geotiff(encoded_path, rows, cols, out_raster.GetGeoTransform(), nodata_value=encoding[3],
+                                    data_type=encoding[0],
+                                    options=["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512", "BIGTIFF=IF_SAFER"])
+            encoded_band = source.GetRasterBand(1)
+            encoded_band.SetScale(encoding[1])
+            encoded_band.SetOffset(encoding[2])
+            for row_off in range(0, rows, block_size):
+                block = band.ReadAsArray(0, row_off, cols, min(block_size, rows - row_off))
+                encoded_band.WriteArray(encode_heights(block, encoding, nodata_value), 0, row_off)
+            encoded_band.FlushCache()
+
+        gdal.GetDriverByName("COG").CreateCopy(output_path, source, options=cog_options(raster_format))
+        source = None
+    finally:
+        out_raster = None
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def write_geotiff(data, geo_transform, output_path, nodata_value=-9999, raster_format=None):
+    """
+    Запись одноканального растра (EPSG:32638) в файл: COG со сжатием, тайлами, обзорными уровнями
+    и выбранным кодированием высот или обычный GeoTIFF Float32 (raster_format['driver'] = "GTiff").
+    """
+    raster_format = resolve_raster_format(raster_format)
+    rows, cols = data.shape
+    if raster_format['driver'] != "COG":
+        out_raster = create_geotiff(output_path, rows, cols, geo_transform, nodata_value=nodata_value)
 
         # Запись данных в растр
         out_band = out_raster.GetRasterBand(1)
         out_band.WriteArray(data)
-        out_band.SetNoDataValue(nodata_value)
         out_band.FlushCache()
+        return
+
+    # COG создается копированием готового набора данных: растр собирается в памяти и копируется в файл
+    encoding = height_encoding(*valid_range(data, nodata_value), raster_format, nodata_value)
+    mem_raster = create_geotiff("", rows, cols, geo_transform, nodata_value=encoding[3], data_type=encoding[0],
+                                driver_name="MEM")
+    mem_band = mem_raster.GetRasterBand(1)
+    if encoding[1:3] != (1.0, 0.0):
+        mem_band.SetScale(encoding[1])
+        mem_band.SetOffset(encoding[2])
+    mem_band.WriteArray(encode_heights(data, encoding, nodata_value))
+    gdal.GetDriverByName("COG").CreateCopy(output_path, mem_raster, options=cog_options(raster_format))
+    mem_raster = None
+
+
+def save_smoothed_raster(data, geo_transform, output_path, nodata_value=-9999, raster_format=None):
+    """
+    Сохранение сглаженного растра в файл GeoTIFF.
+    """
+    try:
+        write_geotiff(data, geo_transform, output_path, nodata_value=nodata_value, raster_format=raster_format)
 
         print(f"Сглаженный растр успешно сохранен: {output_path}")
     except Exception as e:
         print(f"Ошибка при сохранении сглаженного растра: {e}")
 
 
+def rasterize_tile(task):
+    """
+    Создание растра одного тайла (выполняется в отдельном процессе).
+    Тайл обрабатывается вместе с буфером, после чего буфер отрезается,
+    поэтому интерполяция и сглаживание на границах тайлов не дают швов.
+    Если задан ground_path, из высот точек вычитается рельеф, интерполированный по окну
+    растра рельефа с запасом в 1 пиксель (модель высот полога, см. create_chm_from_las).
+    Возвращает окно тайла, исходный и (при sigma) сглаженный растр внутренней части.
+    """
+    (tile_path, window, bounds, pixel_size, shape, tile_buffer,
+     reduction, percentile, sigma, nodata_value, ground_path) = task
+
+    if os.path.exists(tile_path):
+        points = np.fromfile(tile_path, dtype=np.float64).reshape(-1, 3)
+    else:
+        points = np.empty((0, 3), dtype=np.float64)
+    z = points[:, 2]
+    if ground_path is not None:
+        ground = read_raster_window(ground_path, buffer_window(window, shape, tile_buffer), halo=1,
+                                    nodata_value=nodata_value)
+        z = z - interpolate_ground(points, ground)
+        points, z = points[~np.isnan(z)], z[~np.isnan(z)]
+    grid_z, smoothed = grid_tile(points, z, window, bounds, pixel_size, shape, tile_buffer,
+                                 reduction=reduction, percentile=percentile, sigma=sigma, nodata_value=nodata_value)
+    return window, grid_z, smoothed
+
+
+def create_rasters_tiled(file_path, raster_output_path, smoothed_output_path=None, pixel_size=0.1, sigma=1.5,
+                         tile_size=2048, tile_buffer=64, workers=None, chunk_size=5_000_000,
+                         reduction="max", percentile=50, nodata_value=-9999, raster_format=None,
+                         ground_path=None):
+    """
+    Тайловое создание растра (и сглаженного растра, если задан smoothed_output_path) в пуле процессов.
+    Облако точек читается один раз порциями и раскладывается во временные файлы тайлов
+    с перекрытием tile_buffer пикселей. Тайлы растеризуются и сглаживаются параллельно
+    и записываются окнами в общий файл GeoTIFF (для COG — во временный, см. create_output_raster).
+    Если задан ground_path (растр рельефа), строится модель высот полога на сетке рельефа:
+    каждый тайл нормализуется по своему окну рельефа, растр рельефа целиком в память не читается.
+    raster_output_path = None — исходный растр не записывается (только сглаженный).
+    """
+    try:
+        if ground_path is not None:
+            # Сетка модели высот полога совпадает с сеткой рельефа
+            ground_src = gdal.Open(ground_path)
+            min_x, pixel_size, _, max_y, _, _ = ground_src.GetGeoTransform()
+            y_res, x_res = ground_src.RasterYSize, ground_src.RasterXSize
+            ground_src = None
+            bounds = (min_x, min_x + x_res * pixel_size, max_y - y_res * pixel_size, max_y)
+        else:
+            bounds = read_las_bounds(file_path)
+            min_x, max_x, min_y, max_y = bounds
+            x_res = int((max_x - min_x) / pixel_size)
+            y_res = int((max_y - min_y) / pixel_size)
+        shape = (y_res, x_res)
+
+        tile_buffer = min(tile_buffer, tile_size)
+        if smoothed_output_path is not None and tile_buffer < int(4 * sigma + 0.5):
+            print(f"Предупреждение: буфер тайла ({tile_buffer} пикс.) меньше радиуса сглаживания. "
+                  f"На границах тайлов возможны швы.")
+
+        geo_transform = (min_x, pixel_size, 0, max_y, 0, -pixel_size)
+        raster_ds = None
+        if raster_output_path is not None:
+            raster_ds, raster_written_path = create_output_raster(raster_output_path, y_res, x_res, geo_transform,
+                                                                  nodata_value=nodata_value,
+                                                                  raster_format=raster_format)
+        smoothed_ds = None
+        if smoothed_output_path is not None:
+            smoothed_ds, smoothed_written_path = create_output_raster(smoothed_output_path, y_res, x_res, geo_transform,
+                                                                      nodata_value=nodata_value,
+                                                                      raster_format=raster_format)
+
+        tiles = plan_tiles(shape, tile_size)
+        n_tile_cols = -(-x_res // tile_size)
+        with tempfile.TemporaryDirectory() as tiles_folder:
+            # Один проход по облаку точек: раскладка точек по тайлам
+            for points in iter_las_chunks(file_path, chunk_size):
+                split_points_to_tiles(points, bounds, pixel_size, shape, tile_size, tile_buffer, tiles_folder)
+
+            tasks = [
+                (os.path.join(tiles_folder, f"{(row_off // tile_size) * n_tile_cols + col_off // tile_size}.bin"),
+                 (row_off, col_off, height, width), bounds, pixel_size, shape, tile_buffer,
+                 reduction, percentile, sigma if smoothed_ds is not None else None, nodata_value, ground_path)
+                for row_off, col_off, height, width in tiles
+            ]
+
+            # Параллельная растеризация тайлов и запись окон в общий растр
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(rasterize_tile, task) for task in tasks]
+                for done, future in enumerate(as_completed(futures), start=1):
+                    (row_off, col_off, _, _), tile_data, tile_smoothed = future.result()
+                    if raster_ds is not None:
+                        raster_ds.GetRasterBand(1).WriteArray(tile_data, col_off, row_off)
+                    if smoothed_ds is not None:
+                        smoothed_ds.GetRasterBand(1).WriteArray(tile_smoothed, col_off, row_off)
+                    print(f"Обработан тайл {done} из {len(tasks)}")
+
+        if raster_ds is not None:
+            finish_output_raster(raster_ds, raster_written_path, raster_output_path, nodata_value=nodata_value,
+                                 raster_format=raster_format)
+            raster_ds = None
+            print(f"Растр успешно создан: {raster_output_path}")
+        if smoothed_ds is not None:
+            finish_output_raster(smoothed_ds, smoothed_written_path, smoothed_output_path, nodata_value=nodata_value,
+                                 raster_format=raster_format)
+            smoothed_ds = None
+            print(f"Сглаженный растр успешно сохранен: {smoothed_output_path}")
+        return bounds, pixel_size
+
+    except Exception as e:
+        print(f"Ошибка при тайловом создании растра: {e}")
+        return None
+
+
+def read_raster_window(file_path, window, halo=0, nodata_value=-9999):
+    """
+    Чтение окна (row_off, col_off, height, width) растра GeoTIFF, расширенного на halo пикселей
+    в пределах растра, в память (см. raster_in_memory) с декодированием высот.
+    """
+    src = gdal.Open(file_path)
+    band = src.GetRasterBand(1)
+    row_off, col_off, height, width = window
+    row_from, col_from = max(row_off - halo, 0), max(col_off - halo, 0)
+    row_to = min(row_off + height + halo, src.RasterYSize)
+    col_to = min(col_off + width + halo, src.RasterXSize)
+    data = decode_heights(band, band.ReadAsArray(col_from, row_from, col_to - col_from, row_to - row_from),
+                          nodata_value)
+    x_min, x_res, _, y_max, _, y_res = src.GetGeoTransform()
+    geo_transform = (x_min + col_from * x_res, x_res, 0, y_max + row_from * y_res, 0, y_res)
+    src = None
+    return raster_in_memory(data, geo_transform, nodata_value)
+
+
+def create_chm_from_las(file_path, ground, output_path=None, sigma=1.5, chunk_size=5_000_000,
+                        reduction="max", percentile=50, nodata_value=-9999, smooth_block_size=None,
+                        raster_format=None):
+    """
+    Создание модели высот полога (CHM) за один проход по облаку точек леса.
+    Из высоты каждой точки вычитается высота рельефа, интерполированная по растру ground
+    (см. raster_in_memory), и высоты над землей агрегируются сразу на сетке рельефа,
+    поэтому растр леса и выравнивание растров не нужны. Пустые пиксели заполняются
+    интерполяцией, затем CHM сглаживается (sigma) и записывается в output_path (None — без записи).
+
+    :return: Сглаженная CHM в памяти (см. raster_in_memory) или None при ошибке.
+    """
+    try:
+        geo_transform = ground['transform']
+        shape = ground['data'].shape
+        pixel_size = geo_transform[1]
+        bounds = (geo_transform[0], geo_transform[0] + shape[1] * pixel_size,
+                  geo_transform[3] - shape[0] * pixel_size, geo_transform[3])
+
+        # Нормализация точек по рельефу и агрегация по пикселям порциями
+        pixel_grid = init_pixel_grid(shape, reduction) if reduction != "percentile" else None
+        percentile_parts = []
+        for points in iter_las_chunks(file_path, chunk_size):
+            heights = points[:, 2] - interpolate_ground(points, ground)
+            valid = ~np.isnan(heights)
+            rows, cols = points_to_pixels(points[valid], bounds, pixel_size, shape)
+            if pixel_grid is not None:
+                accumulate_points(pixel_grid, rows, cols, heights[valid], reduction)
+            else:
+                percentile_parts.append((rows, cols, heights[valid]))
+
+        if pixel_grid is not None:
+            chm = finalize_pixel_grid(pixel_grid, reduction)
+        else:
+            # Без точек над рельефом reduce_pixels возвращает пустую (NaN) сетку
+            rows, cols, heights = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+            if percentile_parts:
+                rows, cols, heights = (np.concatenate(part) for part in zip(*percentile_parts))
+            chm = reduce_pixels(rows, cols, heights, shape, reduction="percentile", percentile=percentile)
+
+        # Интерполяция только для пикселей без точек, затем сглаживание
+        chm = fill_empty_pixels(chm)
+        chm[np.isnan(chm)] = nodata_value
+        chm = smooth_raster(chm, sigma=sigma, nodata_value=nodata_value, block_size=smooth_block_size)
+
+        if output_path is not None:
+            write_geotiff(chm, geo_transform, output_path, nodata_value=nodata_value, raster_format=raster_format)
+            print(f"Модель высот полога (CHM) сохранена: {output_path}")
+        return raster_in_memory(chm, geo_transform, nodata_value)
+
+    except Exception as e:
+        print(f"Ошибка при создании модели высот полога: {e}")
+        return None
+
+
 def visualize_raster(data, title="Raster", nodata_value=-9999):
     """
     Визуализация растра с исключением значений NoData.
@@ -129,10 +575,38 @@ def visualize_raster(data, title="Raster", nodata_value=-9999):
     plt.show()
 
 
-def process_las_files(las_folder, relief_output_folder, forest_output_folder, pixel_size=0.1, sigma=1.5):
+def raster_in_memory(data, geo_transform, nodata_value=-9999):
+    """
+    Растр в памяти для передачи следующему этапу без записи в файл:
+    массив, геопривязка GDAL (x_min, x_res, 0, y_max, 0, -y_res), система координат и NoData.
+    """
+    return {'data': data, 'transform': geo_transform, 'crs': "EPSG:32638", 'nodata': nodata_value}
+
+
+def process_las_files(las_folder, relief_output_folder, forest_output_folder, pixel_size=0.1, sigma=1.5, chunk_size=None,
+                      canopy_reduction="max", ground_reduction="min", ground_percentile=5,
+                      tile_size=None, tile_buffer=64, workers=None, smooth_block_size=None, save_rasters=True,
+                      raster_format=None, build_chm=False, chm_output_path=None):
     """
     Обработка всех .las файлов в папке: создание растров, сглаживание и сохранение.
+    Если задан chunk_size, .las файлы читаются потоково порциями по chunk_size точек.
+    canopy_reduction и ground_reduction задают агрегацию высот в пикселе для леса и рельефа.
+    Если задан tile_size, растры строятся по тайлам с буфером tile_buffer пикселей
+    в пуле из workers процессов (без визуализации).
+    smooth_block_size — высота полосы (в строках) при поблочном сглаживании.
+    raster_format — формат, сжатие и кодирование высот записываемых растров (см. DEFAULT_RASTER_FORMAT).
+    Если build_chm=True, вместо растра леса строится модель высот полога chm_output_path
+    на сетке рельефа (см. create_chm_from_las) по единственному облаку леса; облако леса
+    обрабатывается после рельефа, в тайловом режиме — по тайлам с окнами рельефа.
+
+    :return: Словарь растров в памяти {'relief': растр рельефа, 'trees': сглаженный растр леса,
+             'chm': сглаженная модель высот полога} (см. raster_in_memory). При save_rasters=False растры
+             не записываются в GeoTIFF; в тайловом режиме растры не держатся в памяти
+             и всегда записываются в файлы.
     """
+    rasters = {}
+    canopy_files = []
+    relief_raster_path = None
     try:
         # Создание выходных папок, если они не существуют
         os.makedirs(relief_output_folder, exist_ok=True)
@@ -142,63 +616,143 @@ def process_las_files(las_folder, relief_output_folder, forest_output_folder, pi
         las_files = [f for f in os.listdir(las_folder) if f.endswith(".las")]
         if not las_files:
             print("В указанной папке нет .las файлов.")
-            return
+            return rasters
 
         for las_file in las_files:
             las_path = os.path.join(las_folder, las_file)
             print(f"Обработка файла: {las_path}")
 
-            # Чтение данных из .las файла
-            points = read_las_file(las_path)
-            if points is None:
-                continue
-
             # Определение типа файла: рельеф или лес
             base_name = os.path.splitext(las_file)[0]
             if "relief" in base_name.lower():
                 output_folder = relief_output_folder
                 is_relief = True
+                reduction = ground_reduction
             elif "cloud" in base_name.lower():
                 output_folder = forest_output_folder
                 is_relief = False
+                reduction = canopy_reduction
             else:
                 print(f"Неизвестный тип файла: {las_file}. Пропускаю.")
                 continue
 
+            # Облака леса для CHM нормализуются по рельефу, поэтому обрабатываются после него
+            if build_chm and not is_relief:
+                canopy_files.append(las_path)
+                continue
+
             # Создание имени выходного файла
             raster_output_path = os.path.join(output_folder, f"{base_name}_raster.tif")
             smoothed_output_path = os.path.join(output_folder, f"{base_name}_smoothed.tif")
+            if is_relief:
+                relief_raster_path = raster_output_path
+
+            # Тайловый режим: растеризация и сглаживание тайлов в пуле процессов
+            if tile_size is not None:
+                if not save_rasters:
+                    print("В тайловом режиме растры записываются в файлы независимо от save_rasters.")
+                create_rasters_tiled(
+                    las_path, raster_output_path,
+                    smoothed_output_path=None if is_relief else smoothed_output_path,
+                    pixel_size=pixel_size, sigma=sigma, tile_size=tile_size, tile_buffer=tile_buffer,
+                    workers=workers, chunk_size=chunk_size or 5_000_000,
+                    reduction=reduction, percentile=ground_percentile, raster_format=raster_format
+                )
+                continue
 
-            # Создание растра
-            raster_data, bounds, _ = create_raster_from_points(points, raster_output_path, pixel_size=pixel_size)
-            if raster_data is None:
+            # Процентиль требует всех точек пикселя сразу, поэтому файл читается целиком
+            streaming = chunk_size is not None and reduction != "percentile"
+            if chunk_size is not None and not streaming:
+                print("Агрегация по процентилю не поддерживает потоковое чтение. Файл будет прочитан целиком.")
+
+            # Чтение данных из .las файла (в потоковом режиме точки читаются при создании растра)
+            points = None
+            if not streaming:
+                points = read_las_file(las_path)
+                if points is None:
+                    continue
+
+            # Создание растра (без записи в файл, если контрольные точки не сохраняются)
+            if not save_rasters:
+                raster_output_path = None
+            if streaming:
+                result = create_raster_from_las(las_path, raster_output_path, pixel_size=pixel_size,
+                                                chunk_size=chunk_size, reduction=reduction, raster_format=raster_format)
+            else:
+                result = create_raster_from_points(points, raster_output_path, pixel_size=pixel_size,
+                                                   reduction=reduction, percentile=ground_percentile,
+                                                   raster_format=raster_format)
+            if result is None:
                 continue
+            raster_data, bounds, _ = result
+
+            # Геопривязка растра
+            geo_transform = (
+                bounds[0],  # x_min
+                pixel_size,  # x_res
+                0,
+                bounds[3],  # y_max
+                0,
+                -pixel_size  # y_res
+            )
 
             # Для рельефа: только сохраняем исходный растр
             if is_relief:
-                print(f"Рельеф обработан и сохранен: {raster_output_path}")
+                rasters['relief'] = raster_in_memory(raster_data, geo_transform)
+                if save_rasters:
+                    print(f"Рельеф обработан и сохранен: {raster_output_path}")
                 continue
 
             # Для леса: сглаживаем растр и сохраняем результат
-            smoothed_data = smooth_raster(raster_data, sigma=sigma)
+            smoothed_data = smooth_raster(raster_data, sigma=sigma, block_size=smooth_block_size)
 
             # Визуализация исходного и сглаженного растра
             visualize_raster(raster_data, title="Original Raster")
             visualize_raster(smoothed_data, title="Smoothed Raster")
 
             # Сохранение сглаженного растра
-            geo_transform = (
-                bounds[0],  # x_min
-                pixel_size,  # x_res
-                0,
-                bounds[3],  # y_max
-                0,
-                -pixel_size  # y_res
-            )
-            save_smoothed_raster(smoothed_data, geo_transform, smoothed_output_path)
+            rasters['trees'] = raster_in_memory(smoothed_data, geo_transform)
+            if save_rasters:
+                save_smoothed_raster(smoothed_data, geo_transform, smoothed_output_path, raster_format=raster_format)
+
+        # Модель высот полога на сетке рельефа
+        if canopy_files:
+            if len(canopy_files) > 1:
+                print(f"Модель высот полога строится по одному облаку леса, найдено {len(canopy_files)}: "
+                      f"{', '.join(os.path.basename(path) for path in canopy_files)}. Объедините облака в один файл.")
+                return rasters
+            if chm_output_path is None:
+                print("Не задан путь к файлу модели высот полога (chm_output_path).")
+                return rasters
+            las_path = canopy_files[0]
+            print(f"Построение модели высот полога: {las_path}")
+
+            # Тайловый режим: тайлы облака леса нормализуются по окнам растра рельефа из файла
+            if tile_size is not None:
+                if relief_raster_path is None or not os.path.exists(relief_raster_path):
+                    print("Для построения модели высот полога нужен растр рельефа (файл relief*.las).")
+                    return rasters
+                create_rasters_tiled(las_path, None, smoothed_output_path=chm_output_path, sigma=sigma,
+                                     tile_size=tile_size, tile_buffer=tile_buffer, workers=workers,
+                                     chunk_size=chunk_size or 5_000_000, reduction=canopy_reduction,
+                                     percentile=ground_percentile, raster_format=raster_format,
+                                     ground_path=relief_raster_path)
+                return rasters
+
+            ground = rasters.get('relief')
+            if ground is None:
+                print("Для построения модели высот полога нужен растр рельефа (файл relief*.las).")
+                return rasters
+            chm = create_chm_from_las(las_path, ground, chm_output_path if save_rasters else None, sigma=sigma,
+                                      chunk_size=chunk_size or 5_000_000, reduction=canopy_reduction,
+                                      percentile=ground_percentile, smooth_block_size=smooth_block_size,
+                                      raster_format=raster_format)
+            if chm is not None:
+                rasters['chm'] = chm
 
     except Exception as e:
         print(f"Ошибка при обработке файлов: {e}")
+    return rasters
 
 
 if __name__ == "__main__":
@@ -0,0 +1,280 @@
+# Операции с сеткой растра без GDAL: агрегация точек по пикселям, заполнение пропусков,
+# сглаживание, разбиение на тайлы. Чтение и запись растров — в rast.py.
+import os
+import numpy as np
+from scipy.ndimage import gaussian_filter, binary_dilation, map_coordinates
+from scipy.interpolate import griddata
+from scipy.spatial import QhullError
+
+def points_to_pixels(points, bounds, pixel_size, shape):
+    """
+    Перевод координат точек в индексы пикселей (строка, столбец) растра.
+    Строка 0 соответствует верхнему краю растра (max_y).
+    """
+    min_x, _, _, max_y = bounds
+    rows, cols = shape
+    col = ((points[:, 0] - min_x) / pixel_size).astype(np.int64)
+    row = ((max_y - points[:, 1]) / pixel_size).astype(np.int64)
+    np.clip(col, 0, cols - 1, out=col)
+    np.clip(row, 0, rows - 1, out=row)
+    return row, col
+
+
+def init_pixel_grid(shape, reduction="max"):
+    """
+    Создание накопителя значений по пикселям для заданного способа агрегации
+    ("max", "min" или "mean").
+    """
+    if reduction == "max":
+        return {'values': np.full(shape, -np.inf, dtype=np.float32)}
+    if reduction == "min":
+        return {'values': np.full(shape, np.inf, dtype=np.float32)}
+    if reduction == "mean":
+        return {'values': np.zeros(shape, dtype=np.float64), 'counts': np.zeros(shape, dtype=np.uint32)}
+    raise ValueError(f"Способ агрегации '{reduction}' не поддерживается при накоплении по порциям!")
+
+
+def accumulate_points(pixel_grid, rows, cols, z, reduction="max"):
+    """
+    Добавление высот точек в накопитель: каждая точка учитывается в своем пикселе.
+    """
+    values = pixel_grid['values']
+    index = rows * values.shape[1] + cols
+    if reduction == "max":
+        np.maximum.at(values.reshape(-1), index, z.astype(np.float32))
+    elif reduction == "min":
+        np.minimum.at(values.reshape(-1), index, z.astype(np.float32))
+    else:
+        np.add.at(values.reshape(-1), index, z)
+        np.add.at(pixel_grid['counts'].reshape(-1), index, 1)
+
+
+def finalize_pixel_grid(pixel_grid, reduction="max"):
+    """
+    Преобразование накопителя в растр float32. Пиксели без точек получают NaN.
+    """
+    values = pixel_grid['values']
+    if reduction == "mean":
+        counts = pixel_grid['counts']
+        with np.errstate(invalid="ignore", divide="ignore"):
+            grid_z = (values / counts).astype(np.float32)
+        grid_z[counts == 0] = np.nan
+        return grid_z
+    values[np.isinf(values)] = np.nan
+    return values
+
+
+def reduce_pixels(rows, cols, z, shape, reduction="max", percentile=50):
+    """
+    Агрегация высот точек по пикселям с уже вычисленными индексами (строка, столбец).
+    Значение пикселя — максимум ("max"), минимум ("min"), среднее ("mean")
+    или процентиль ("percentile") высот попавших в него точек; пустые пиксели — NaN.
+    """
+    if reduction != "percentile":
+        pixel_grid = init_pixel_grid(shape, reduction)
+        accumulate_points(pixel_grid, rows, cols, z, reduction)
+        return finalize_pixel_grid(pixel_grid, reduction)
+
+    # Нет точек (например, пустой тайл): все пиксели пустые
+    grid_z = np.full(shape, np.nan, dtype=np.float32)
+    if len(z) == 0:
+        return grid_z
+
+    # Процентиль: сортировка точек по пикселю и высоте, затем линейная интерполяция внутри группы
+    index = rows * shape[1] + cols
+    order = np.lexsort((z, index))
+    index, z = index[order], z[order]
+    starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+    counts = np.diff(np.r_[starts, len(index)])
+
+    position = starts + (percentile / 100.0) * (counts - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    values = z[lower] + (z[upper] - z[lower]) * (position - lower)
+
+    grid_z.reshape(-1)[index[starts]] = values
+    return grid_z
+
+
+def bin_points_to_grid(points, bounds, pixel_size, shape, reduction="max", percentile=50):
+    """
+    Биннинг точек в пиксели растра без триангуляции (см. reduce_pixels).
+    """
+    rows, cols = points_to_pixels(points, bounds, pixel_size, shape)
+    return reduce_pixels(rows, cols, points[:, 2], shape, reduction=reduction, percentile=percentile)
+
+
+def fill_empty_pixels(grid_z):
+    """
+    Заполнение пустых (NaN) пикселей линейной интерполяцией.
+    Триангуляция строится только по заполненным пикселям, граничащим с пустыми,
+    поэтому ее размер определяется площадью пропусков, а не числом точек.
+    Пиксели вне выпуклой оболочки остаются NaN.
+    """
+    empty = np.isnan(grid_z)
+    if not empty.any() or empty.all():
+        return grid_z
+
+    support = ~empty & binary_dilation(empty, structure=np.ones((3, 3), dtype=bool))
+    support_rows, support_cols = np.nonzero(support)
+    if len(support_rows) < 3:
+        return grid_z
+
+    empty_rows, empty_cols = np.nonzero(empty)
+    try:
+        grid_z[empty_rows, empty_cols] = griddata(
+            np.column_stack((support_rows, support_cols)),
+            grid_z[support_rows, support_cols],
+            (empty_rows, empty_cols),
+            method='linear'
+        )
+    except QhullError as e:
+        print(f"Не удалось заполнить пустые пиксели растра: {e}")
+    return grid_z
+
+
+def smooth_block(block, sigma=1.5, nodata_value=-9999):
+    """
+    Сглаживание блока нормированной сверткой: данные (NoData = 0) и веса валидности
+    фильтруются отдельно, затем делятся друг на друга. NoData не влияют на соседние пиксели.
+    Результат float32, пиксели NoData сохраняются.
+    """
+    valid = np.isfinite(block) & (block != nodata_value)
+    values = np.where(valid, block, 0).astype(np.float32, copy=False)
+    weights = valid.astype(np.float32)
+
+    # Фильтрация на месте, без дополнительных полноразмерных копий
+    gaussian_filter(values, sigma=sigma, output=values, mode='reflect')
+    gaussian_filter(weights, sigma=sigma, output=weights, mode='reflect')
+    np.divide(values, weights, out=values, where=weights > 0)
+
+    # Восстанавливаем NoData значения
+    values[~valid] = nodata_value
+    return values
+
+
+def smooth_raster(input_data, sigma=1.5, nodata_value=-9999, block_size=None):
+    """
+    Сглаживание растра с использованием гауссовского фильтра.
+    Исключает значения NoData из процесса сглаживания (нормированная свертка).
+    Если задан block_size, растр обрабатывается полосами по block_size строк
+    с перекрытием на радиус фильтра — результат совпадает с обработкой целиком.
+    """
+    if block_size is None or block_size >= input_data.shape[0]:
+        return smooth_block(input_data, sigma=sigma, nodata_value=nodata_value)
+
+    halo = int(4.0 * sigma + 0.5)  # Радиус гауссовского ядра (truncate=4.0)
+    smoothed_data = np.empty(input_data.shape, dtype=np.float32)
+    for row_off in range(0, input_data.shape[0], block_size):
+        row_from = max(row_off - halo, 0)
+        row_to = min(row_off + block_size + halo, input_data.shape[0])
+        block = smooth_block(input_data[row_from:row_to], sigma=sigma, nodata_value=nodata_value)
+        smoothed_data[row_off:row_off + block_size] = block[row_off - row_from:row_off - row_from + block_size]
+    return smoothed_data
+
+
+def plan_tiles(shape, tile_size):
+    """
+    Разбиение растра на тайлы размером tile_size x tile_size пикселей.
+    Возвращает список окон (row_off, col_off, height, width).
+    """
+    rows, cols = shape
+    return [
+        (row_off, col_off, min(tile_size, rows - row_off), min(tile_size, cols - col_off))
+        for row_off in range(0, rows, tile_size)
+        for col_off in range(0, cols, tile_size)
+    ]
+
+
+def split_points_to_tiles(points, bounds, pixel_size, shape, tile_size, tile_buffer, tiles_folder):
+    """
+    Раскладка порции точек по временным файлам тайлов.
+    Точка попадает в свой тайл и в соседние, если лежит в их буферной зоне.
+    """
+    rows, cols = points_to_pixels(points, bounds, pixel_size, shape)
+    n_tile_rows = -(-shape[0] // tile_size)
+    n_tile_cols = -(-shape[1] // tile_size)
+    tile_rows, tile_cols = rows // tile_size, cols // tile_size
+    inner_rows, inner_cols = rows % tile_size, cols % tile_size
+
+    # Принадлежность точки тайлу-соседу по строкам (-1, 0, +1) и столбцам
+    row_shift = {-1: inner_rows < tile_buffer, 0: None, 1: inner_rows >= tile_size - tile_buffer}
+    col_shift = {-1: inner_cols < tile_buffer, 0: None, 1: inner_cols >= tile_size - tile_buffer}
+
+    for dr, row_mask in row_shift.items():
+        for dc, col_mask in col_shift.items():
+            mask = np.ones(len(points), dtype=bool)
+            if row_mask is not None:
+                mask &= row_mask
+            if col_mask is not None:
+                mask &= col_mask
+            target_rows, target_cols = tile_rows[mask] + dr, tile_cols[mask] + dc
+            inside = (target_rows >= 0) & (target_rows < n_tile_rows) & (target_cols >= 0) & (target_cols < n_tile_cols)
+            tile_index = target_rows[inside] * n_tile_cols + target_cols[inside]
+            if len(tile_index) == 0:
+                continue
+
+            order = np.argsort(tile_index, kind="stable")
+            tile_index, tile_points = tile_index[order], points[mask][inside][order]
+            starts = np.flatnonzero(np.r_[True, tile_index[1:] != tile_index[:-1]])
+            ends = np.r_[starts[1:], len(tile_index)]
+            for start, end in zip(starts, ends):
+                with open(os.path.join(tiles_folder, f"{tile_index[start]}.bin"), "ab") as tile_file:
+                    tile_points[start:end].tofile(tile_file)
+
+
+def interpolate_ground(points, ground):
+    """
+    Высота рельефа под каждой точкой: билинейная интерполяция растра рельефа
+    по центрам пикселей. Для точек вне растра или рядом с NoData возвращается NaN.
+    """
+    x_min, x_res, _, y_max, _, y_res = ground['transform']
+    data = ground['data'].astype(np.float32)
+    data[data == ground['nodata']] = np.nan
+
+    # Дробные индексы (строка, столбец) относительно центров пикселей
+    rows = (points[:, 1] - y_max) / y_res - 0.5
+    cols = (points[:, 0] - x_min) / x_res - 0.5
+    ground_z = map_coordinates(data, [rows, cols], order=1, mode='nearest', prefilter=False)
+
+    outside = (rows < -0.5) | (rows > data.shape[0] - 0.5) | (cols < -0.5) | (cols > data.shape[1] - 0.5)
+    ground_z[outside] = np.nan
+    return ground_z
+
+
+def buffer_window(window, shape, tile_buffer):
+    """
+    Окно тайла вместе с буфером tile_buffer пикселей, обрезанное по границам растра.
+    """
+    row_off, col_off, height, width = window
+    buffer_row_off = max(row_off - tile_buffer, 0)
+    buffer_col_off = max(col_off - tile_buffer, 0)
+    buffer_rows = min(row_off + height + tile_buffer, shape[0]) - buffer_row_off
+    buffer_cols = min(col_off + width + tile_buffer, shape[1]) - buffer_col_off
+    return buffer_row_off, buffer_col_off, buffer_rows, buffer_cols
+
+
+def grid_tile(points, z, window, bounds, pixel_size, shape, tile_buffer, reduction="max", percentile=50,
+              sigma=None, nodata_value=-9999):
+    """
+    Растр одного тайла по точкам тайла с буфером и их высотам z.
+    Интерполяция пропусков и сглаживание выполняются на окне с буфером, после чего буфер отрезается.
+    Возвращает исходный и (при sigma) сглаженный растр внутренней части тайла.
+    """
+    row_off, col_off, height, width = window
+    buffer_row_off, buffer_col_off, buffer_rows, buffer_cols = buffer_window(window, shape, tile_buffer)
+
+    rows, cols = points_to_pixels(points, bounds, pixel_size, shape)
+    grid_z = reduce_pixels(rows - buffer_row_off, cols - buffer_col_off, z,
+                           (buffer_rows, buffer_cols), reduction=reduction, percentile=percentile)
+    del rows, cols
+
+    grid_z = fill_empty_pixels(grid_z)
+    grid_z[np.isnan(grid_z)] = nodata_value
+
+    interior = (slice(row_off - buffer_row_off, row_off - buffer_row_off + height),
+                slice(col_off - buffer_col_off, col_off - buffer_col_off + width))
+    smoothed = None
+    if sigma is not None:
+        smoothed = smooth_raster(grid_z, sigma=sigma, nodata_value=nodata_value)[interior]
+    return grid_z[interior], smoothed
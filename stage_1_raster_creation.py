@@ -3,14 +3,27 @@ from rast import process_las_files
 
 def stage_1():
     print("Этап 1: Создание растров из LAS-файлов...")
-    process_las_files(
+    rasters = process_las_files(
         las_folder=LAS_FOLDER,
         relief_output_folder=RELIEF_OUTPUT_FOLDER,
         forest_output_folder=FOREST_OUTPUT_FOLDER,
         pixel_size=PIXEL_SIZE,
-        sigma=SIGMA
+        sigma=SIGMA,
+        chunk_size=CHUNK_SIZE,
+        canopy_reduction=CANOPY_REDUCTION,
+        ground_reduction=GROUND_REDUCTION,
+        ground_percentile=GROUND_PERCENTILE,
+        tile_size=TILE_SIZE,
+        tile_buffer=TILE_BUFFER,
+        workers=N_WORKERS,
+        smooth_block_size=SMOOTH_BLOCK_SIZE,
+        save_rasters=SAVE_CHECKPOINTS,
+        raster_format=RASTER_FORMAT,
+        build_chm=USE_CHM,
+        chm_output_path=chm_raster_path
     )
     print("Этап 1 завершен.")
+    return rasters
 
 if __name__ == "__main__":
     stage_1()
\ No newline at end of file
@@ -1,10 +1,23 @@
 from config import *
 from tree_detection import find_tree_tops_with_coords
 
-def stage_2():
+def stage_2(rasters=None):
     print("\nЭтап 2: Поиск вершин деревьев...")
-    find_tree_tops_with_coords()
+    rasters = rasters or {}  # Растры в памяти с этапа 1 (иначе читаются файлы)
+    tree_tops_gdf = find_tree_tops_with_coords(
+        relief_raster_path=relief_raster_path,
+        trees_raster_path=trees_raster_path,
+        output_path=output_path,
+        workers=N_WORKERS,
+        cluster_tile_size=CLUSTER_TILE_SIZE,
+        relief_raster=rasters.get('relief'),
+        trees_raster=rasters.get('trees'),
+        save_output=SAVE_CHECKPOINTS,
+        chm_raster_path=chm_raster_path if USE_CHM else None,
+        chm_raster=rasters.get('chm') if USE_CHM else None
+    )
     print("Этап 2 завершен.")
+    return tree_tops_gdf
 
 if __name__ == "__main__":
     stage_2()
\ No newline at end of file
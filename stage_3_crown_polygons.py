@@ -3,14 +3,17 @@ from crona import create_crown_polygons_with_attributes
 from config import k
 
 
-def stage_3():
+def stage_3(tree_tops_gdf=None):
     print("\nЭтап 3: Создание полигонов крон деревьев...")
-    create_crown_polygons_with_attributes(
+    crowns_gdf = create_crown_polygons_with_attributes(
         input_points_path=input_points_path,
         output_polygons_path=output_polygons_path,
-        k=k
+        k=k,
+        points_gdf=tree_tops_gdf,
+        save_output=SAVE_CHECKPOINTS
     )
     print("Этап 3 завершен.")
+    return crowns_gdf
 
 if __name__ == "__main__":
     stage_3()
\ No newline at end of file
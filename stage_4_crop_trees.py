@@ -2,14 +2,20 @@ import os
 from config import *
 from crop import crop_point_cloud_by_polygons
 
-def stage_4():
+def stage_4(crowns_gdf=None):
     print("\nЭтап 4: Вырезание отдельных деревьев...")
-    crop_point_cloud_by_polygons(
+    tree_points = crop_point_cloud_by_polygons(
         input_shp_path=input_shp_path,
         input_las_path=os.path.join(LAS_FOLDER, "Cloud.las"),
-        output_folder=POINT_CLOUD_CROP_FOLDER
+        output_folder=POINT_CLOUD_CROP_FOLDER,
+        chunk_size=CHUNK_SIZE,
+        workers=N_WORKERS,
+        compress=CROP_COMPRESS,
+        polygons_gdf=crowns_gdf,
+        save_files=SAVE_CHECKPOINTS
     )
     print("Этап 4 завершен.")
+    return tree_points
 
 if __name__ == "__main__":
     stage_4()
\ No newline at end of file
@@ -1,15 +1,22 @@
 from config import *
 from tree_profile import add_las_attributes_and_plot
 
-def stage_5():
+def stage_5(tree_points=None, crowns_gdf=None):
     print("\nЭтап 5: Добавление атрибутов высоты из LAS-файлов и построение графиков...")
-    add_las_attributes_and_plot(
+    crowns_gdf, profiles = add_las_attributes_and_plot(
         output_crowns_shp=output_crowns_shp,
         input_cropped_folder=input_cropped_folder,
         output_cropped_folder=output_cropped_folder,
-        output_tree_profile_folder=output_tree_profile_folder
+        output_tree_profile_folder=output_tree_profile_folder,
+        tree_points=tree_points,
+        save_png=SAVE_PROFILE_PNG or CLASSIFY_FROM_PNG,
+        image_size=PROFILE_IMAGE_SIZE,
+        plot_workers=N_WORKERS,
+        crowns_gdf=crowns_gdf,
+        save_output=SAVE_CHECKPOINTS
     )
     print("Этап 5 завершен.")
+    return crowns_gdf, profiles
 
 if __name__ == "__main__":
     stage_5()
\ No newline at end of file
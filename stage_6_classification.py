@@ -1,15 +1,42 @@
 from config import *
 from Efficintnet import classify_trees_and_update_shp
+from tree_profile import load_tree_profiles
+from vector_io import write_vector
 
-def stage_6():
+def stage_6(profiles=None, crowns_gdf=None):
     print("\nЭтап 6: Классификация деревьев...")
-    classify_trees_and_update_shp(
+
+    # Классификация по PNG (IMAGE_FOLDER) или по профилям в памяти; без профилей этапа 5
+    # они строятся по вырезанным облакам точек деревьев
+    if CLASSIFY_FROM_PNG:
+        profiles = None
+    elif profiles is None:
+        profiles = load_tree_profiles(input_cropped_folder, image_size=PROFILE_IMAGE_SIZE)
+
+    crowns_gdf = classify_trees_and_update_shp(
         model_path=MODEL_PATH,
         image_folder=IMAGE_FOLDER,
         shp_path=SHP_PATH,
-        output_shp_path=OUTPUT_SHP_PATH
+        output_shp_path=OUTPUT_SHP_PATH,
+        batch_size=BATCH_SIZE,
+        num_workers=LOADER_WORKERS,
+        num_threads=TORCH_THREADS,
+        profiles=profiles,
+        compiled=COMPILED_MODEL,
+        model_name=MODEL_NAME,
+        image_size=INPUT_SIZE,
+        quantization=QUANTIZATION,
+        calibration_folder=CALIBRATION_FOLDER,
+        calibration_size=CALIBRATION_SIZE,
+        crowns_gdf=crowns_gdf
     )
+
+    # Итоговый слой в Shapefile — только как необязательный экспорт (названия атрибутов усекаются до 10 символов)
+    if EXPORT_SHP_PATH and EXPORT_SHP_PATH != OUTPUT_SHP_PATH:
+        write_vector(crowns_gdf, EXPORT_SHP_PATH)
+        print(f"Слой крон экспортирован в Shapefile: {EXPORT_SHP_PATH}")
     print("Этап 6 завершен.")
+    return crowns_gdf
 
 if __name__ == "__main__":
     stage_6()
\ No newline at end of file
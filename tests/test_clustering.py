@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from clustering import dbscan_tiled
+
+DBSCAN = pytest.importorskip("sklearn.cluster").DBSCAN
+
+
+def random_points(seed):
+    """
+    Скопления точек и редкий шум на участке 200 x 200 м (несколько тайлов по 30 м).
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0, 200, size=(40, 2))
+    clusters = np.concatenate([center + rng.normal(0, 1.5, size=(rng.integers(5, 60), 2)) for center in centers])
+    noise = rng.uniform(0, 200, size=(300, 2))
+    return np.concatenate([clusters, noise])
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_dbscan_tiled_matches_sklearn(seed):
+    coords = random_points(seed)
+    eps, min_samples = 2.0, 5
+    labels = dbscan_tiled(coords, eps, min_samples=min_samples, tile_size=30.0)
+    reference = DBSCAN(eps=eps, min_samples=min_samples).fit(coords)
+
+    # Шум совпадает
+    np.testing.assert_array_equal(labels == -1, reference.labels_ == -1)
+
+    # Кластеры ядровых точек совпадают с точностью до нумерации
+    core = np.zeros(len(coords), dtype=bool)
+    core[reference.core_sample_indices_] = True
+    pairs = set(zip(labels[core], reference.labels_[core]))
+    assert len(pairs) == len(set(labels[core])) == len(set(reference.labels_[core]))
+
+    # Граничная точка относится к кластеру одной из ядровых точек в радиусе eps
+    for index in np.flatnonzero(~core & (labels >= 0)):
+        near_core = core & (np.hypot(*(coords - coords[index]).T) <= eps)
+        assert labels[index] in set(labels[near_core])
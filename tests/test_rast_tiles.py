@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+
+from raster_grid import plan_tiles, reduce_pixels, smooth_block, split_points_to_tiles, grid_tile
+
+
+def test_tiled_rasterization_matches_whole_raster(tmp_path):
+    """
+    Растр, собранный из тайлов с буфером (grid_tile), совпадает с растеризацией
+    и сглаживанием (smooth_block) всего растра. В каждом пикселе есть точка,
+    поэтому интерполяция пустых пикселей не влияет на результат.
+    """
+    rng = np.random.default_rng(0)
+    pixel_size, shape, tile_size, tile_buffer, sigma = 0.5, (150, 170), 64, 8, 1.5
+    bounds = (1000.0, 1000.0 + shape[1] * pixel_size, 2000.0, 2000.0 + shape[0] * pixel_size)
+
+    rows, cols = np.indices(shape).reshape(2, -1)
+    centers = np.column_stack((bounds[0] + (cols + 0.5) * pixel_size, bounds[3] - (rows + 0.5) * pixel_size))
+    extra = np.column_stack((rng.uniform(bounds[0], bounds[1], 20000), rng.uniform(bounds[2], bounds[3], 20000)))
+    xy = np.concatenate([centers, extra])
+    points = np.column_stack((xy, 10 + np.sin(xy[:, 0] / 7) * 5 + rng.normal(0, 0.5, len(xy))))
+
+    point_rows = ((bounds[3] - points[:, 1]) / pixel_size).astype(np.int64)
+    point_cols = ((points[:, 0] - bounds[0]) / pixel_size).astype(np.int64)
+    whole = reduce_pixels(point_rows, point_cols, points[:, 2], shape, reduction="max")
+    whole_smoothed = smooth_block(whole, sigma=sigma)
+
+    split_points_to_tiles(points, bounds, pixel_size, shape, tile_size, tile_buffer, str(tmp_path))
+    n_tile_cols = -(-shape[1] // tile_size)
+    tiled = np.full(shape, np.nan, dtype=np.float32)
+    tiled_smoothed = np.full(shape, np.nan, dtype=np.float32)
+    for window in plan_tiles(shape, tile_size):
+        row_off, col_off, height, width = window
+        tile_path = os.path.join(tmp_path, f"{(row_off // tile_size) * n_tile_cols + col_off // tile_size}.bin")
+        tile_points = np.fromfile(tile_path, dtype=np.float64).reshape(-1, 3)
+        data, smoothed = grid_tile(tile_points, tile_points[:, 2], window, bounds, pixel_size, shape, tile_buffer,
+                                   reduction="max", sigma=sigma)
+        tiled[row_off:row_off + height, col_off:col_off + width] = data
+        tiled_smoothed[row_off:row_off + height, col_off:col_off + width] = smoothed
+
+    np.testing.assert_array_equal(tiled, whole)
+    np.testing.assert_allclose(tiled_smoothed, whole_smoothed, atol=1e-4)
@@ -1,12 +1,20 @@
+import os
+from collections import deque
+from contextlib import ExitStack
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from scipy.ndimage import maximum_filter, minimum_filter, label
 from skimage.segmentation import watershed
 import rasterio
 from rasterio.warp import reproject, Resampling
-from rasterio.transform import xy
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+from affine import Affine
 import geopandas as gpd
-from shapely.geometry import Point
-from sklearn.cluster import DBSCAN  # Добавляем импорт DBSCAN
+from clustering import dbscan_tiled
+from vector_io import write_vector
+import config
 
 def align_rasters(source_path, target_path):
     """
@@ -29,127 +37,330 @@ def align_rasters(source_path, target_path):
         
         return aligned_data, tgt.transform, tgt.crs
 
-def find_tree_tops_with_coords():
-    # Пути к растрам
-    relief_raster_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\GeoTIFF рельеф\relief_raster.tif"
-    trees_raster_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\GeoTIFF лес\Cloud_smoothed.tif"
+class ArrayRaster:
+    """
+    Растр в памяти (результат этапа 1) с тем же интерфейсом чтения окнами, что и у набора данных rasterio.
+    """
+
+    def __init__(self, data, transform, crs, nodata=None):
+        self.data = data
+        self.transform = transform
+        self.crs = crs
+        self.nodata = nodata
+        self.scales = (1.0,)
+        self.offsets = (0.0,)
+        self.shape = data.shape
+        self.height, self.width = data.shape
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def read(self, band=1, window=None):
+        if window is None:
+            return self.data
+        return self.data[window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width]
+
+
+def open_raster(raster_path, raster=None):
+    """
+    Открытие растра для чтения окнами: растр в памяти ({'data', 'transform', 'crs', 'nodata'},
+    геопривязка в формате GDAL) или файл GeoTIFF.
+    """
+    if raster is not None:
+        return ArrayRaster(raster['data'], Affine.from_gdal(*raster['transform']), raster['crs'], raster['nodata'])
+    return rasterio.open(raster_path)
+
+
+def open_aligned_trees(trees_src, relief_src):
+    """
+    Подготовка растра деревьев к чтению окнами на сетке растра рельефа.
+    Если сетки различаются, растр деревьев ресемплируется на лету (WarpedVRT, билинейно);
+    растр в памяти ресемплируется целиком.
+    """
+    if trees_src.shape == relief_src.shape and trees_src.transform == relief_src.transform:
+        return trees_src
+    print("Размеры растров различаются. Выполняется выравнивание...")
+    if isinstance(trees_src, ArrayRaster):
+        nodata = trees_src.nodata if trees_src.nodata is not None else np.nan
+        aligned_data = np.full(relief_src.shape, nodata, dtype=np.float32)
+        reproject(
+            source=trees_src.data,
+            destination=aligned_data,
+            src_transform=trees_src.transform,
+            src_crs=trees_src.crs,
+            src_nodata=nodata,
+            dst_transform=relief_src.transform,
+            dst_crs=relief_src.crs,
+            dst_nodata=nodata,
+            resampling=Resampling.bilinear
+        )
+        return ArrayRaster(aligned_data, relief_src.transform, relief_src.crs, nodata)
+    return WarpedVRT(
+        trees_src,
+        crs=relief_src.crs,
+        transform=relief_src.transform,
+        width=relief_src.width,
+        height=relief_src.height,
+        resampling=Resampling.bilinear
+    )
 
-    # Чтение данных рельефа
-    with rasterio.open(relief_raster_path) as relief_src:
-        relief_data = relief_src.read(1)
-        relief_transform = relief_src.transform
-        relief_crs = relief_src.crs
-        relief_no_data = relief_src.nodata
 
-    # Чтение данных деревьев
-    with rasterio.open(trees_raster_path) as trees_src:
-        trees_data = trees_src.read(1)
-        trees_transform = trees_src.transform
-        trees_crs = trees_src.crs
-        trees_no_data = trees_src.nodata
+def read_band_window(src, window):
+    """
+    Чтение окна первого канала растра в метрах (NoData -> NaN).
+    Для растров с кодированием высот float16/int16 применяются масштаб и смещение канала.
+    """
+    data = src.read(1, window=window).astype(np.float32)
+    invalid = data == src.nodata if src.nodata is not None else None
+    scale, offset = src.scales[0], src.offsets[0]
+    if scale != 1.0 or offset != 0.0:
+        data = data * np.float32(scale) + np.float32(offset)
+    if invalid is not None:
+        data[invalid] = np.nan
+    return data
 
-    # Выравнивание растров
-    if relief_data.shape != trees_data.shape:
-        print("Размеры растров различаются. Выполняется выравнивание...")
-        trees_data, trees_transform, trees_crs = align_rasters(trees_raster_path, relief_raster_path)
 
-    # Замена NoData значений на NaN
-    relief_data[relief_data == relief_no_data] = np.nan
-    trees_data[trees_data == trees_no_data] = np.nan
+def read_height_window(relief_src, trees_src, window):
+    """
+    Чтение окна растров и вычисление высоты деревьев над рельефом (NoData -> NaN).
+    Отрицательные высоты заменяются на NaN.
+    """
+    relief_data = read_band_window(relief_src, window)
+    trees_data = read_band_window(trees_src, window)
 
     # Вычисление высоты деревьев
     height_data = trees_data - relief_data
-    height_data[height_data < 0] = np.nan  # Игнорируем отрицательные значения
-
-    # Проверка количества отрицательных значений
-    negative_pixels = np.sum(height_data < 0)
-    print(f"Количество пикселей с отрицательной высотой: {negative_pixels}")
-
-    # Автоматическая настройка параметров
-    resolution = max(relief_transform[0], -relief_transform[4]) or 0.5
-    valid_heights = height_data[~np.isnan(height_data)]
-    if len(valid_heights) == 0:
-        raise ValueError("Растр не содержит допустимых значений высот!")
-
-    avg_height = np.nanmean(valid_heights)
-    std_height = np.nanstd(valid_heights)
-
-    # Определение размера блока
-    block_size = 1000
-
-    # Список для хранения всех найденных вершин
-    all_points = []
-
-    # Обработка данных блоками
-    for y in range(0, height_data.shape[0], block_size):
-        for x in range(0, height_data.shape[1], block_size):
-            # Извлечение блока
-            block = height_data[y:y + block_size, x:x + block_size]
-
-            # Предварительная обработка блока
-            smoothed = maximum_filter(block, size=2)  # Уменьшаем размер фильтра
-            smoothed = minimum_filter(smoothed, size=2)
-
-            # Поиск локальных максимумов
-            window_size = max(2, int(1 / resolution))  # Уменьшаем размер окна
-            local_max = (smoothed == maximum_filter(smoothed, size=window_size))
-            threshold = max(avg_height - 0.2 * std_height, np.nanmin(block))  # Уменьшаем порог
-
-            # Создаем маркеры для водораздела
-            markers = local_max.astype(int)
-            labels = watershed(-smoothed, markers, mask=~np.isnan(block))
-
-            # Фильтрация кандидатов
-            candidates = np.where(labels > 0)
-
-            # Подготовка данных о вершинах
-            for cy, cx in zip(*candidates):
-                px, py = xy(relief_transform, y + cy, x + cx)  # Преобразование индексов пикселей в координаты
-                all_points.append({
-                    'geometry': Point(px, py),
-                    'height': round(block[cy, cx], 1),  # Округляем высоту до десятых
-                    'x_coord': round(px, 1),           # Округляем координаты до десятых
-                    'y_coord': round(py, 1)
-                })
+    negative = height_data < 0
+    height_data[negative] = np.nan  # Игнорируем отрицательные значения
+    return height_data, int(negative.sum())
+
+
+def read_chm_window(chm_src, window):
+    """
+    Чтение окна готовой модели высот полога (NoData -> NaN, отрицательные высоты -> NaN).
+    """
+    height_data = read_band_window(chm_src, window)
+    negative = height_data < 0
+    height_data[negative] = np.nan
+    return height_data, int(negative.sum())
+
+
+def iter_windows(shape, block_size, halo=0):
+    """
+    Перебор окон растра размером block_size с перекрытием halo пикселей.
+    Возвращает пары (окно с перекрытием, срезы внутренней части окна).
+    """
+    rows, cols = shape
+    for row_off in range(0, rows, block_size):
+        for col_off in range(0, cols, block_size):
+            height = min(block_size, rows - row_off)
+            width = min(block_size, cols - col_off)
+            row_from, col_from = max(row_off - halo, 0), max(col_off - halo, 0)
+            row_to, col_to = min(row_off + height + halo, rows), min(col_off + width + halo, cols)
+            window = Window(col_from, row_from, col_to - col_from, row_to - row_from)
+            interior = (slice(row_off - row_from, row_off - row_from + height),
+                        slice(col_off - col_from, col_off - col_from + width))
+            yield window, interior
+
+
+def detect_candidates(block, interior, resolution, avg_height, std_height):
+    """
+    Поиск кандидатов в вершины деревьев в окне с перекрытием.
+    Фильтры и водораздел считаются по всему окну, а кандидаты возвращаются
+    только из внутренней части, поэтому вершины на границах окон не теряются и не дублируются.
+    Возвращает индексы (строка, столбец) кандидатов внутри окна, их высоты и порог.
+    """
+    # Предварительная обработка блока
+    smoothed = maximum_filter(block, size=2)  # Уменьшаем размер фильтра
+    smoothed = minimum_filter(smoothed, size=2)
+
+    # Поиск локальных максимумов
+    window_size = max(2, int(1 / resolution))  # Уменьшаем размер окна
+    local_max = (smoothed == maximum_filter(smoothed, size=window_size))
+    threshold = max(avg_height - 0.2 * std_height, np.nanmin(block))  # Уменьшаем порог
+
+    # Создаем маркеры для водораздела
+    markers = local_max.astype(int)
+    labels = watershed(-smoothed, markers, mask=~np.isnan(block))
+
+    # Фильтрация кандидатов: только внутренняя часть окна
+    interior_labels = np.zeros_like(labels, dtype=bool)
+    interior_labels[interior] = labels[interior] > 0
+    cy, cx = np.nonzero(interior_labels)
+    return cy, cx, block[cy, cx], threshold
+
+
+def detect_window(task):
+    """
+    Обработка одного окна в процессе-обработчике.
+    Возвращает компактные массивы глобальных индексов (строка, столбец), высот кандидатов и порог.
+    """
+    block, interior, row_off, col_off, resolution, avg_height, std_height = task
+    cy, cx, heights, threshold = detect_candidates(block, interior, resolution, avg_height, std_height)
+    return ((cy + row_off).astype(np.int32), (cx + col_off).astype(np.int32),
+            heights.astype(np.float32), threshold)
+
+
+def map_windows_ordered(executor, tasks, max_pending):
+    """
+    Отправка задач в пул с ограничением числа одновременно ожидающих задач.
+    Результаты возвращаются в порядке задач, поэтому объединение детерминировано.
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(detect_window, task))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def pixels_to_coords(transform, rows, cols):
+    """
+    Векторное преобразование индексов пикселей в координаты центров пикселей
+    (аналог rasterio.transform.xy для массивов).
+    """
+    col_centers = np.asarray(cols, dtype=np.float64) + 0.5
+    row_centers = np.asarray(rows, dtype=np.float64) + 0.5
+    px = transform.a * col_centers + transform.b * row_centers + transform.c
+    py = transform.d * col_centers + transform.e * row_centers + transform.f
+    return px, py
+
+
+def find_tree_tops_with_coords(relief_raster_path=None, trees_raster_path=None, output_path=None,
+                               block_size=1000, halo=None, workers=None, cluster_tile_size=50.0,
+                               relief_raster=None, trees_raster=None, save_output=True,
+                               chm_raster_path=None, chm_raster=None):
+    """
+    Поиск вершин деревьев по растрам рельефа и деревьев или по готовой модели высот полога.
+    Растры читаются окнами rasterio размером block_size с перекрытием halo пикселей,
+    поэтому потребление памяти не зависит от размера растра.
+    Окна обрабатываются параллельно в пуле из workers процессов (None — все ядра).
+    Кандидаты кластеризуются по тайлам размером cluster_tile_size метров.
+    relief_raster и trees_raster — растры в памяти с этапа 1 (см. rast.raster_in_memory);
+    если они заданы, соответствующие файлы не читаются.
+    Если задана модель высот полога (chm_raster_path или chm_raster в памяти), высоты читаются
+    из нее, а растры рельефа и деревьев не используются.
+
+    :return: GeoDataFrame вершин деревьев (в файл output_path записывается только при save_output=True).
+    """
+    # Пути к растрам (по умолчанию из config.py)
+    if relief_raster_path is None:
+        relief_raster_path = config.relief_raster_path
+    if trees_raster_path is None:
+        trees_raster_path = config.trees_raster_path
+    if output_path is None:
+        output_path = config.output_path
+
+    with ExitStack() as stack:
+        if chm_raster_path is not None or chm_raster is not None:
+            # Готовая модель высот полога: одно чтение окна без вычитания и выравнивания растров
+            relief_src = stack.enter_context(open_raster(chm_raster_path, chm_raster))
+            read_window = partial(read_chm_window, relief_src)
+        else:
+            relief_src = stack.enter_context(open_raster(relief_raster_path, relief_raster))
+            trees_raw_src = stack.enter_context(open_raster(trees_raster_path, trees_raster))
+            trees_src = open_aligned_trees(trees_raw_src, relief_src)
+            read_window = partial(read_height_window, relief_src, trees_src)
+        relief_transform = relief_src.transform
+        relief_crs = relief_src.crs
+
+        # Автоматическая настройка параметров
+        resolution = max(relief_transform[0], -relief_transform[4]) or 0.5
+        if halo is None:
+            halo = 2 * max(2, int(1 / resolution))
+
+        # Первый проход: статистика высот без загрузки растра целиком
+        count, total, total_sq, max_height, negative_pixels = 0, 0.0, 0.0, -np.inf, 0
+        for window, _ in iter_windows(relief_src.shape, block_size):
+            height_data, negative = read_window(window)
+            valid_heights = height_data[~np.isnan(height_data)].astype(np.float64)
+            negative_pixels += negative
+            if len(valid_heights) == 0:
+                continue
+            count += len(valid_heights)
+            total += valid_heights.sum()
+            total_sq += np.square(valid_heights).sum()
+            max_height = max(max_height, valid_heights.max())
+
+        # Проверка количества отрицательных значений
+        print(f"Количество пикселей с отрицательной высотой: {negative_pixels}")
+
+        if count == 0:
+            raise ValueError("Растр не содержит допустимых значений высот!")
+
+        avg_height = total / count
+        std_height = np.sqrt(max(total_sq / count - avg_height ** 2, 0.0))
+
+        # Кандидаты хранятся колоночно: массивы строк, столбцов и высот по окнам
+        candidate_rows, candidate_cols, candidate_heights = [], [], []
+        threshold = avg_height
+
+        # Второй проход: окна с перекрытием читаются здесь, а обрабатываются в пуле процессов
+        def window_tasks():
+            for window, interior in iter_windows(relief_src.shape, block_size, halo):
+                block, _ = read_window(window)
+                if np.isnan(block).all():
+                    continue
+                yield block, interior, window.row_off, window.col_off, resolution, avg_height, std_height
+
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for rows, cols, heights, threshold in map_windows_ordered(executor, window_tasks(), 2 * workers):
+                candidate_rows.append(rows)
+                candidate_cols.append(cols)
+                candidate_heights.append(heights)
+
+    rows = np.concatenate(candidate_rows) if candidate_rows else np.empty(0, dtype=np.int32)
+    cols = np.concatenate(candidate_cols) if candidate_cols else np.empty(0, dtype=np.int32)
+    heights = np.concatenate(candidate_heights) if candidate_heights else np.empty(0, dtype=np.float32)
+
+    # Преобразование индексов пикселей в координаты центров пикселей (векторно)
+    px, py = pixels_to_coords(relief_transform, rows, cols)
 
     # Создание GeoDataFrame из всех найденных точек
-    gdf = gpd.GeoDataFrame(all_points, crs=relief_crs)
+    gdf = gpd.GeoDataFrame(
+        {
+            'height': np.round(heights, 1),  # Округляем высоту до десятых
+            'x_coord': np.round(px, 1),      # Округляем координаты до десятых
+            'y_coord': np.round(py, 1)
+        },
+        geometry=gpd.points_from_xy(px, py),
+        crs=relief_crs
+    )
 
-    # Пространственная фильтрация с использованием DBSCAN
+    # Пространственная фильтрация: DBSCAN по тайлам с объединением через границы тайлов
     coords = np.column_stack((gdf['x_coord'], gdf['y_coord']))  # Формируем массив координат
-    clustering = DBSCAN(eps=resolution * 3, min_samples=5).fit(coords)  # Кластеризация
-    gdf['cluster'] = clustering.labels_  # Добавляем метки кластеров в GeoDataFrame
+    gdf['cluster'] = dbscan_tiled(coords, eps=resolution * 3, min_samples=5,
+                                  tile_size=cluster_tile_size)  # Добавляем метки кластеров в GeoDataFrame
 
     # Фильтрация точек: удаляем шумовые точки (метка -1)
     filtered_gdf = gdf[gdf['cluster'] != -1]
 
-    # Назначение ID деревьев
-    confirmed_trees = []
-    current_id = 1
-
-    for cluster_id in filtered_gdf['cluster'].unique():
-        cluster_points = filtered_gdf[filtered_gdf['cluster'] == cluster_id]
-        highest_point = cluster_points.loc[cluster_points['height'].idxmax()]  # Находим самую высокую точку в кластере
-        highest_point['tree_id'] = current_id
-        confirmed_trees.append(highest_point.to_dict())
-        current_id += 1
+    # Самая высокая точка каждого кластера за один групповой проход
+    # (кластеры в порядке первого появления, как при переборе unique())
+    highest_idx = filtered_gdf.groupby('cluster', sort=False)['height'].idxmax()
+    confirmed_gdf = filtered_gdf.loc[highest_idx.values].reset_index(drop=True)
 
-    # Создание итогового GeoDataFrame
-    confirmed_gdf = gpd.GeoDataFrame(confirmed_trees, crs=relief_crs)
+    # Назначение ID деревьев
+    confirmed_gdf['tree_id'] = np.arange(1, len(confirmed_gdf) + 1)
 
     # Сохранение точечного слоя в файл
-    output_path = r"C:\Работа\Магистратура\Четвертый семестр\проект Таксация леса\Points\tree_tops.shp"
-    confirmed_gdf.to_file(output_path, driver="ESRI Shapefile")
-
-    print(f"Точечный слой сохранен: {output_path}")
+    if save_output:
+        write_vector(confirmed_gdf, output_path)
+        print(f"Точечный слой сохранен: {output_path}")
 
     # Вывод статистики
     print(f"Результаты обработки:\n"
-          f"• Обнаружено деревьев: {len(confirmed_trees)}\n"
+          f"• Обнаружено деревьев: {len(confirmed_gdf)}\n"
           f"• Средняя высота: {avg_height:.1f} м\n"
-          f"• Максимальная высота: {np.nanmax(height_data):.1f} м\n"
+          f"• Максимальная высота: {max_height:.1f} м\n"
           f"• Разрешение: {resolution:.2f} м/пиксель\n"
           f"• Использованный порог: {threshold:.1f} м")
+    return confirmed_gdf
 
 if __name__ == "__main__":
     find_tree_tops_with_coords()
\ No newline at end of file
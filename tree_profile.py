@@ -1,12 +1,203 @@
 import os
-import geopandas as gpd
+import io
 import laspy
 import numpy as np
-import matplotlib.pyplot as plt
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+from vector_io import read_vector, write_vector
 
-def add_las_attributes_and_plot(output_crowns_shp, input_cropped_folder, output_cropped_folder, output_tree_profile_folder):
+# Прозрачность точек на графиках профилей (как у диаграммы рассеяния в get_profile_renderer)
+PROFILE_POINT_ALPHA = 0.5
+
+
+def rasterize_profile(horizontal, z, image_size=600):
+    """
+    Проекция точек дерева на вертикальную плоскость в изображение image_size x image_size.
+    Масштаб по обеим осям одинаковый (как set_aspect('equal')), поля 5%, дерево центрируется,
+    высота растет вверх. Значение пикселя — непрозрачность наложенных точек 1 - (1 - alpha)^n
+    (n точек с прозрачностью PROFILE_POINT_ALPHA, как на графике рассеяния): одна точка дает 0.5,
+    поэтому плотные пиксели не «выбеливают» остальные, как при нормировке плотности по максимуму.
+    """
+    horizontal = np.asarray(horizontal, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64)
+    extent = 1.1 * max(np.ptp(horizontal), np.ptp(z), 1e-6)
+    scale = image_size / extent
+
+    h_from = (horizontal.min() + horizontal.max() - extent) / 2
+    z_from = (z.min() + z.max() - extent) / 2
+    cols = np.clip(((horizontal - h_from) * scale).astype(np.int64), 0, image_size - 1)
+    rows = np.clip(image_size - 1 - ((z - z_from) * scale).astype(np.int64), 0, image_size - 1)
+
+    counts = np.bincount(rows * image_size + cols, minlength=image_size * image_size)
+    coverage = 1.0 - np.power(1.0 - PROFILE_POINT_ALPHA, counts)
+    return coverage.reshape(image_size, image_size).astype(np.float32)
+
+
+def render_tree_profiles(x, y, z, image_size=600):
+    """
+    Профили дерева для классификации: вид сбоку XZ и вид сбоку YZ.
+    """
+    return rasterize_profile(x, z, image_size), rasterize_profile(y, z, image_size)
+
+
+class TreeProfiles(Mapping):
+    """
+    Профили деревьев {tree_id: (профиль XZ, профиль YZ)}, которые строятся при обращении.
+    Хранятся только источники — массив точек (N, 3) дерева или путь к его LAS-файлу,
+    поэтому два массива image_size x image_size на дерево (2.9 МБ при 600 пикселях)
+    существуют только для деревьев текущего батча классификации.
+    """
+
+    def __init__(self, sources, image_size=600):
+        self.sources = sources
+        self.image_size = image_size
+
+    def __getitem__(self, tree_id):
+        source = self.sources[tree_id]
+        if isinstance(source, str):
+            las = laspy.read(source)
+            x, y, z = las.x, las.y, las.z
+        else:
+            x, y, z = np.asarray(source).T
+        return render_tree_profiles(x, y, z, image_size=self.image_size)
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def __len__(self):
+        return len(self.sources)
+
+
+def load_tree_profiles(input_cropped_folder, image_size=600):
+    """
+    Профили по облакам точек деревьев из папки ({tree_id}.las / {tree_id}.laz).
+    Используется, когда профили не переданы из этапа 5 в памяти; файлы читаются при обращении к профилю.
+    """
+    sources = {}
+    for file_name in sorted(os.listdir(input_cropped_folder)):
+        stem, extension = os.path.splitext(file_name)
+        if extension.lower() not in (".las", ".laz"):
+            continue
+        tree_id = int(stem) if stem.isdigit() else stem
+        sources[tree_id] = os.path.join(input_cropped_folder, file_name)
+    return TreeProfiles(sources, image_size)
+
+
+# Фигура для отрисовки профилей: создается один раз в каждом процессе и переиспользуется
+_profile_renderer = None
+
+
+def create_profile_renderer():
+    """
+    Фигура, оси и диаграмма рассеяния для профилей дерева.
+    Отрисовка выполняется через холст Agg напрямую (без pyplot и оконного интерфейса).
+    """
+    fig = Figure(figsize=(6, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    scatter = ax.scatter([], [], s=1, alpha=0.5)
+    ax.set_ylabel("Z (м) - Height")
+    ax.grid(True)
+    ax.set_aspect('equal')  # Равный масштаб
+    return fig, ax, scatter
+
+
+def get_profile_renderer():
+    """
+    Фигура для профилей, общая для процесса: при повторных вызовах обновляются только данные диаграммы.
+    Используется только в однопоточных процессах пула (save_profile_plots_task).
+    """
+    global _profile_renderer
+    if _profile_renderer is None:
+        _profile_renderer = create_profile_renderer()
+    return _profile_renderer
+
+
+def iter_profile_plots(x, y, z, renderer=None):
+    """
+    Отрисовка профилей дерева (XZ и YZ) на фигуре renderer (None — общая фигура процесса,
+    см. get_profile_renderer): для каждого вида возвращает (номер вида, фигура) после обновления данных диаграммы.
+    """
+    fig, ax, scatter = renderer or get_profile_renderer()
+    views = [
+        ("1", x, 'green', "Side View (XZ)", "X (м)"),   # 1. Вид сбоку (XZ)
+        ("2", y, 'purple', "Side View (YZ)", "Y (м)"),  # 2. Вид сбоку (YZ)
+    ]
+    z = np.asarray(z, dtype=np.float64)
+    for suffix, horizontal, color, title, xlabel in views:
+        horizontal = np.asarray(horizontal, dtype=np.float64)
+        scatter.set_offsets(np.column_stack((horizontal, z)))
+        scatter.set_color(color)
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
+
+        # Границы осей с полями 5%, как при автоматическом масштабировании
+        for set_lim, values in ((ax.set_xlim, horizontal), (ax.set_ylim, z)):
+            low, high = float(np.min(values)), float(np.max(values))
+            margin = 0.05 * (high - low) or 0.5
+            set_lim(low - margin, high + margin)
+        yield suffix, fig
+
+
+def save_profile_plots(tree_id, x, y, z, output_tree_profile_folder, dpi=300):
+    """
+    Сохранение профилей дерева (XZ и YZ) в файлы PNG {tree_id}_1.png и {tree_id}_2.png.
+    """
+    output_image_paths = []
+    for suffix, fig in iter_profile_plots(x, y, z):
+        output_image_path = os.path.join(output_tree_profile_folder, f"{tree_id}_{suffix}.png")
+        fig.savefig(output_image_path, dpi=dpi)
+        output_image_paths.append(output_image_path)
+    return output_image_paths
+
+
+def render_profile_plot_images(x, y, z, dpi=300):
+    """
+    Графики профилей дерева (XZ и YZ) в памяти — те же изображения PNG, что сохраняет
+    save_profile_plots, без записи на диск. Возвращает список изображений PIL (RGB).
+    Фигура создается при каждом вызове, поэтому функцию можно вызывать из нескольких потоков
+    (сервис классификации обрабатывает запросы в пуле потоков).
+    """
+    images = []
+    for _, fig in iter_profile_plots(x, y, z, renderer=create_profile_renderer()):
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", dpi=dpi)
+        buffer.seek(0)
+        images.append(Image.open(buffer).convert("RGB"))
+    return images
+
+
+def save_profile_plots_task(task):
+    """
+    Отрисовка профилей одного дерева в процессе-обработчике.
+    """
+    return save_profile_plots(*task)
+
+
+def add_las_attributes_and_plot(output_crowns_shp, input_cropped_folder, output_cropped_folder, output_tree_profile_folder,
+                                tree_points=None, save_png=False, image_size=600, plot_workers=None,
+                                crowns_gdf=None, save_output=True):
+    """
+    Расчет высоты деревьев по облакам точек и построение профилей.
+    tree_points — словарь {tree_id: массив точек (N, 3)} из этапа вырезания;
+    если он задан, облака точек берутся из памяти без повторного чтения LAS-файлов.
+    Профили XZ/YZ (image_size x image_size) возвращаются отображением {tree_id: (профиль XZ, профиль YZ)},
+    которое строит их при обращении (см. TreeProfiles); PNG сохраняются только при save_png=True
+    в пуле из plot_workers процессов.
+    crowns_gdf — слой крон в памяти (с этапа 3); если он задан, output_crowns_shp не читается.
+
+    :return: Слой крон с атрибутом height_tree_las (в файл output_cropped_folder записывается
+             только при save_output=True) и словарь профилей.
+    """
     # Загрузка SHP-файла
-    crowns_gdf = gpd.read_file(output_crowns_shp)
+    if crowns_gdf is None:
+        crowns_gdf = read_vector(output_crowns_shp)
+    else:
+        crowns_gdf = crowns_gdf.copy()
 
     # Проверка наличия необходимых атрибутов
     if 'tree_id' not in crowns_gdf.columns:
@@ -15,77 +206,78 @@ def add_las_attributes_and_plot(output_crowns_shp, input_cropped_folder, output_
     # Создание нового столбца для высоты дерева из LAS-файла
     crowns_gdf['height_tree_las'] = None
 
-    # Создание папки для сохранения графиков
-    os.makedirs(output_tree_profile_folder, exist_ok=True)
+    # Создание папки и пула процессов для сохранения графиков
+    plot_executor, pending_plots = None, deque()
+    if save_png:
+        os.makedirs(output_tree_profile_folder, exist_ok=True)
+        plot_workers = plot_workers or os.cpu_count() or 1
+        plot_executor = ProcessPoolExecutor(max_workers=plot_workers)
 
-    # Обработка каждого дерева
-    for idx, row in crowns_gdf.iterrows():
-        tree_id = row['tree_id']
-        las_file_name = f"{tree_id}.las"
-        las_file_path = os.path.join(input_cropped_folder, las_file_name)
+    profile_sources = {}
 
-        # Проверка существования LAS-файла
-        if not os.path.exists(las_file_path):
-            print(f"LAS-файл для дерева с ID {tree_id} не найден. Пропускаем.")
-            continue
+    # Пул закрывается и при ошибке (невалидный LAS-файл, ошибка отрисовки), ожидающие графики отменяются
+    try:
+        # Обработка каждого дерева
+        for idx, row in crowns_gdf.iterrows():
+            tree_id = row['tree_id']
 
-        # Чтение LAS-файла
-        try:
-            las = laspy.read(las_file_path)
-        except Exception as e:
-            print(f"Ошибка при чтении LAS-файла для дерева с ID {tree_id}: {e}")
-            continue
+            # Облако точек дерева из памяти (если передано с этапа вырезания)
+            if tree_points is not None and tree_id in tree_points:
+                x, y, z = tree_points[tree_id].T
+                profile_sources[tree_id] = tree_points[tree_id]
+            else:
+                las_file_name = f"{tree_id}.las"
+                las_file_path = os.path.join(input_cropped_folder, las_file_name)
+                if not os.path.exists(las_file_path):
+                    las_file_path = os.path.join(input_cropped_folder, f"{tree_id}.laz")  # Сжатый вариант
+
+                # Проверка существования LAS-файла
+                if not os.path.exists(las_file_path):
+                    print(f"LAS-файл для дерева с ID {tree_id} не найден. Пропускаем.")
+                    continue
+
+                # Чтение LAS-файла
+                try:
+                    las = laspy.read(las_file_path)
+                except Exception as e:
+                    print(f"Ошибка при чтении LAS-файла для дерева с ID {tree_id}: {e}")
+                    continue
+
+                # Извлечение координат
+                x = las.x
+                y = las.y
+                z = las.z
+                profile_sources[tree_id] = las_file_path
+
+            # Расчет высоты дерева
+            height_tree_las = z.max() - z.min()
+
+            # Запись значения высоты в GeoDataFrame
+            crowns_gdf.at[idx, 'height_tree_las'] = height_tree_las
+
+            print(f"Обработано дерево с ID {tree_id}: height_tree_las={height_tree_las:.2f}")
+
+            # Графики PNG (число ожидающих задач ограничено)
+            if save_png:
+                task = (tree_id, np.asarray(x), np.asarray(y), np.asarray(z), output_tree_profile_folder)
+                pending_plots.append(plot_executor.submit(save_profile_plots_task, task))
+                if len(pending_plots) >= 2 * plot_workers:
+                    for output_image_path in pending_plots.popleft().result():
+                        print(f"График сохранен: {output_image_path}")
 
-        # Извлечение координат
-        x = las.x
-        y = las.y
-        z = las.z
-
-        # Расчет высоты дерева
-        height_tree_las = z.max() - z.min()
-
-        # Запись значения высоты в GeoDataFrame
-        crowns_gdf.at[idx, 'height_tree_las'] = height_tree_las
-
-        print(f"Обработано дерево с ID {tree_id}: height_tree_las={height_tree_las:.2f}")
-
-        # 1. Вид сбоку (XZ)
-        fig1, ax1 = plt.subplots(figsize=(6, 6))
-        ax1.scatter(x, z, s=1, c='green', alpha=0.5)
-        ax1.set_title("Side View (XZ)")
-        ax1.set_xlabel("X (м)")
-        ax1.set_ylabel("Z (м) - Height")
-        ax1.grid(True)
-        ax1.set_aspect('equal')  # Равный масштаб
-
-        # Сохранение первого графика
-        output_image_path_1 = os.path.join(output_tree_profile_folder, f"{tree_id}_1.png")
-        fig1.savefig(output_image_path_1, dpi=300)
-        print(f"График сохранен: {output_image_path_1}")
-
-        # Очистка памяти после создания графика
-        plt.close(fig1)
-
-        # 2. Вид сбоку (YZ)
-        fig2, ax2 = plt.subplots(figsize=(6, 6))
-        ax2.scatter(y, z, s=1, c='purple', alpha=0.5)
-        ax2.set_title("Side View (YZ)")
-        ax2.set_xlabel("Y (м)")
-        ax2.set_ylabel("Z (м) - Height")
-        ax2.grid(True)
-        ax2.set_aspect('equal')  # Равный масштаб
-
-        # Сохранение второго графика
-        output_image_path_2 = os.path.join(output_tree_profile_folder, f"{tree_id}_2.png")
-        fig2.savefig(output_image_path_2, dpi=300)
-        print(f"График сохранен: {output_image_path_2}")
-
-        # Очистка памяти после создания графика
-        plt.close(fig2)
+        # Ожидание оставшихся графиков
+        while pending_plots:
+            for output_image_path in pending_plots.popleft().result():
+                print(f"График сохранен: {output_image_path}")
+    finally:
+        if plot_executor is not None:
+            plot_executor.shutdown(cancel_futures=True)
 
     # Сохранение обновленного SHP-файла
-    crowns_gdf.to_file(output_cropped_folder, driver="ESRI Shapefile")
-    print(f"Обновленный SHP-файл сохранен: {output_cropped_folder}")
+    if save_output:
+        write_vector(crowns_gdf, output_cropped_folder)
+        print(f"Обновленный слой крон сохранен: {output_cropped_folder}")
+    return crowns_gdf, TreeProfiles(profile_sources, image_size)
 
 # Пример использования
 if __name__ == "__main__":
@@ -0,0 +1,49 @@
+import os
+import geopandas as gpd
+
+# Формат векторного слоя определяется расширением файла
+VECTOR_FORMATS = {
+    ".parquet": "GeoParquet",
+    ".fgb": "FlatGeobuf",
+    ".gpkg": "GPKG",
+    ".shp": "ESRI Shapefile",
+    ".shx": "ESRI Shapefile",
+}
+
+
+def vector_format(path):
+    """
+    Формат векторного слоя по расширению файла.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in VECTOR_FORMATS:
+        raise ValueError(f"Неизвестный формат векторного слоя: {path} (поддерживаются {', '.join(VECTOR_FORMATS)})")
+    return VECTOR_FORMATS[extension]
+
+
+def read_vector(path, columns=None):
+    """
+    Чтение векторного слоя (GeoParquet, FlatGeobuf, GeoPackage или Shapefile).
+    columns — список читаемых атрибутов (None — все).
+    """
+    if vector_format(path) == "GeoParquet":
+        if columns is not None:
+            columns = list(columns) + ["geometry"]
+        return gpd.read_parquet(path, columns=columns)
+    return gpd.read_file(path, columns=columns)
+
+
+def write_vector(gdf, path):
+    """
+    Запись векторного слоя в формате, заданном расширением файла.
+    GeoParquet и FlatGeobuf не ограничены 2 ГБ и не усекают названия атрибутов, в отличие от Shapefile.
+    """
+    driver = vector_format(path)
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    if driver == "GeoParquet":
+        gdf.to_parquet(path, index=False)
+    else:
+        gdf.to_file(path, driver=driver)
+    return path